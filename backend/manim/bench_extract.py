@@ -0,0 +1,95 @@
+"""Microbenchmarks for prompts.find_code against the old regex cascade.
+
+Run with: python bench_extract.py [--size N]
+
+Each input is timed with the single-pass scanner and with the previous
+extract_code_only fallback chain (kept here as legacy_find_code), and the two
+are checked to return the same code.
+"""
+import argparse
+import re
+import time
+
+from prompts import find_code
+
+def legacy_find_code(text):
+    """The regex cascade extract_code_only used before find_code, without topic validation"""
+    match = re.search(r'<CODE_START>(.*?)<CODE_END>', text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    
+    match = re.search(r'```python\s*(.*?)\s*```', text, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+    
+    match = re.search(r'```\s*(.*?)\s*```', text, re.DOTALL)
+    if match:
+        code = match.group(1).strip()
+        if "import" in code or "class" in code:
+            return code
+    
+    if "from manim import" in text:
+        start_idx = text.find("from manim import")
+        end_markers = ["\n\n<code_self_evaluation>", "\n\n---", "\n\nThis code"]
+        end_idx = len(text)
+        for marker in end_markers:
+            marker_pos = text.find(marker, start_idx)
+            if marker_pos != -1 and marker_pos < end_idx:
+                end_idx = marker_pos
+        return text[start_idx:end_idx].strip()
+    
+    match = re.search(r'class\s+\w+\s*\(\s*Scene\s*\).*?def\s+construct\s*\(\s*self\s*\)', text, re.DOTALL)
+    if match:
+        start_idx = match.start()
+        import_idx = text.rfind("import", 0, start_idx)
+        if import_idx != -1:
+            line_start = text.rfind("\n", 0, import_idx)
+            start_idx = line_start + 1 if line_start != -1 else 0
+        end_idx = len(text)
+        for marker in ["\n\n<code_self_evaluation>", "\n\n---", "\n\nThis code"]:
+            marker_pos = text.find(marker, start_idx)
+            if marker_pos != -1:
+                end_idx = marker_pos
+                break
+        return text[start_idx:end_idx].strip()
+    
+    return None
+
+def pathological_inputs(size):
+    """Inputs that make the regex cascade scan the whole response many times"""
+    scene = "class Demo(Scene):\n    pass\n"
+    return {
+        "tagged code": "<CODE_START>\nfrom manim import *\n" + scene * (size // 30) + "<CODE_END>",
+        "unterminated tag": "<CODE_START>\n" + "x = 1\n" * (size // 6),
+        "scenes without construct": "import numpy\n" + scene * (size // 30),
+        "repeated Scene openings": "class A(" * (size // 8),
+        "long identifier": "class " + "a" * size,
+        "many unmatched fences": "``` text\n" * (size // 9),
+        "prose only": "The animation shows a vector. " * (size // 30),
+    }
+
+def best_time(function, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark code extraction on pathological responses")
+    parser.add_argument("--size", type=int, default=200000, help="Approximate input size in characters")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement (best is reported)")
+    args = parser.parse_args()
+    
+    print(f"{'input':<28}{'chars':>10}{'find_code ms':>14}{'legacy ms':>12}  strategy")
+    for name, text in pathological_inputs(args.size).items():
+        code, strategy = find_code(text)
+        if code != legacy_find_code(text):
+            print(f"MISMATCH on {name!r}")
+        new = best_time(find_code, text, args.repeat)
+        old = best_time(legacy_find_code, text, args.repeat)
+        print(f"{name:<28}{len(text):>10}{new * 1000:>14.2f}{old * 1000:>12.2f}  {strategy}")
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,185 @@
 import os
-import subprocess
+import asyncio
 import re
+import json
+import hashlib
 import shutil
-from setup import ManimGenerator
+import difflib
+import threading
+import itertools
+import collections
+import concurrent.futures
+from setup import ManimGenerator, AsyncManimGenerator
+from response_cache import ResponseCache
+from rate_limit import RateLimiter
+from token_budget import TokenBudget
+from scene_check import ManimAPIIndex, check_scene, format_problems
+from render_pool import RenderPool
+from partial_cache import PartialMovieCache
+from metrics import PipelineMetrics, start_tracking, stop_tracking, format_summary
+
+# Artifact file each pipeline stage is checkpointed to, in pipeline order
+STAGE_CHECKPOINTS = {
+    "concept": "01_concept_analysis.txt",
+    "design": "02_animation_design.txt",
+    "testing": "03_design_testing.txt",
+    "code": "04_code.py",
+}
+
+# Artifact file recording the run inputs the stage checkpoints were made for
+RUN_CHECKPOINT = "00_run.json"
+
+class VideoResult(collections.namedtuple("VideoResult", ["success", "video_path", "code_path", "metrics", "upgrade"])):
+    """Outcome of one topic's run; immutable, so it can be passed between threads as is.
+    
+    video_path and code_path are None when the run failed, metrics is the
+    per-stage token and latency summary, and upgrade is a Future for the
+    background final-quality render, or None.
+    """
+    __slots__ = ()
+
+# What _save_video hands to _finish_run: the saved preview, the generation of the
+# topic's video it started and the code it was rendered from
+_SavedVideo = collections.namedtuple("_SavedVideo", ["video_path", "generation", "code"])
 
 class VideoGenerator:
-    def __init__(self, api_key):
+    def __init__(self, api_key, use_cache=True, cache_only=False, streaming=True,
+                 requests_per_minute=50, tokens_per_minute=40000, fused=False, candidates=1,
+                 resume=False, render_fixes=2, max_tokens_percentile=95, llm_backend=None,
+                 static_check=True, warm_render=True, render_workers=None, render_memory_mb=None,
+                 render_cpu_seconds=None, final_quality=None, partial_cache_mb=2048,
+                 segmented_render=False, dry_run=True):
         # Create directories in the user's home directory
         curr_dir = os.path.dirname(os.path.abspath(__file__))
-        self.code_dir = os.path.join(curr_dir, "content", "code_dir")
-        self.videos_dir = os.path.join(curr_dir, "content", "videos_dir")
+        content_dir = os.path.join(curr_dir, "content")
+        if llm_backend:
+            # Replay runs (see replay.py) keep their outputs, history and rate limits
+            # apart from real runs and from the recordings they replay
+            content_dir = os.path.join(content_dir, "replay")
+            use_cache = cache_only = False
+        self.code_dir = os.path.join(content_dir, "code_dir")
+        self.videos_dir = os.path.join(content_dir, "videos_dir")
+        self.cache_dir = os.path.join(content_dir, "llm_cache")
         
         # Create necessary directories
         os.makedirs(self.code_dir, exist_ok=True)
         os.makedirs(self.videos_dir, exist_ok=True)
         
+        # Persistent response cache so re-runs of a topic skip the API
+        cache = None
+        if use_cache or cache_only:
+            cache = ResponseCache(self.cache_dir, cache_only=cache_only)
+        
+        # Token buckets shared by every process on this machine through a state file
+        self.rate_limiter = None
+        if requests_per_minute or tokens_per_minute:
+            self.rate_limiter = RateLimiter(
+                os.path.join(content_dir, "rate_limit.json"),
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute
+            )
+        
+        # Per-stage max_tokens learned from past response lengths; 0 keeps the fixed defaults
+        token_budget = None
+        if max_tokens_percentile:
+            token_budget = TokenBudget(
+                os.path.join(content_dir, "token_history.json"),
+                percentile=max_tokens_percentile
+            )
+        
+        # Fused mode asks for analysis, design and design testing in one API call
+        self.fused = fused
+        
+        # Number of code candidates to generate and render in parallel (async path only)
+        self.candidates = max(1, candidates)
+        
+        # Reuse checkpointed stages from a previous run of the same topic
+        self.resume = resume
+        
+        # Patch-and-rerender attempts after a Manim error before giving up
+        self.render_fixes = max(0, render_fixes)
+        
+        # Check generated code against the installed Manim API before launching Manim
+        self.api_index = None
+        if static_check:
+            self.api_index = ManimAPIIndex(os.path.join(content_dir, "manim_api_index.json"))
+        
+        # Rendered play() calls shared by every render, topic and run; 0 disables
+        self.partial_cache = None
+        if partial_cache_mb:
+            self.partial_cache = PartialMovieCache(
+                os.path.join(content_dir, "partial_movie_cache"),
+                max_bytes=partial_cache_mb * 1024 ** 2
+            )
+        
+        # Parallel renders, each in a long-lived process that imports Manim only once
+        self.render_pool = RenderPool(
+            workers=render_workers,
+            warm=warm_render,
+            memory_mb=render_memory_mb,
+            cpu_seconds=render_cpu_seconds,
+            cache=self.partial_cache
+        )
+        
+        # Split each scene into ranges of play() calls rendered in parallel
+        self.segmented_render = segmented_render
+        
+        # Run construct() without rendering before each render, so broken code
+        # fails in a second instead of partway through the render
+        self.dry_run = dry_run
+        self._dry_run_unavailable = threading.Event()
+        
+        # Quality a video is re-rendered at in the background once its -ql preview
+        # is saved; None keeps the preview as the final video. Saving a preview
+        # starts a new generation of the topic's video, and an upgrade only
+        # replaces the preview of the generation it was scheduled for
+        self.final_quality = final_quality
+        self._upgrade_lock = threading.Lock()
+        self._upgrade_generations = {}
+        
+        # Numbers the videos being rendered into videos_dir so no two share a file
+        self._render_ids = itertools.count()
+        
         # Initialize generator with API key
-        self.generator = ManimGenerator(api_key=api_key)
+        self.api_key = api_key
+        self.llm_backend = llm_backend
+        self.generator = ManimGenerator(
+            api_key=api_key,
+            cache=cache,
+            streaming=streaming,
+            rate_limiter=self.rate_limiter,
+            token_budget=token_budget,
+            client=llm_backend.client() if llm_backend else None
+        )
+    
+    def close(self):
+        """Stop the render workers"""
+        self.render_pool.close()
     
     def _get_safe_filename(self, math_topic):
         """Convert math topic to a safe filename"""
         return math_topic.lower().replace(' ', '_').replace('/', '_').replace('\\', '_').replace(':', '_')
+    
+    def _code_path(self, math_topic):
+        """Path of the topic's generated code, generated_<topic>.py in code_dir"""
+        return os.path.join(self.code_dir, f"generated_{self._get_safe_filename(math_topic)}.py")
+    
+    def _media_dir(self, filepath):
+        """Media directory of the renders of one code file, shared with no other file"""
+        return os.path.join(self.code_dir, "media", os.path.splitext(os.path.basename(filepath))[0])
+    
+    def _video_path(self, math_topic):
+        """Path the topic's video is served from, <topic>_animation.mp4 in videos_dir"""
+        return os.path.join(self.videos_dir, f"{self._get_safe_filename(math_topic)}_animation.mp4")
+    
+    def _render_path(self, math_topic):
+        """A new file next to the topic's video for a render to write to.
+        
+        The render is renamed over the served video once it is complete, so the
+        video is never read half written and never copied.
+        """
+        video_path = self._video_path(math_topic)
+        return f"{video_path[:-len('.mp4')]}.rendering-{os.getpid()}-{next(self._render_ids)}.mp4"
         
     def _extract_class_name(self, code):
         """Extract the class name from the generated code"""
@@ -29,42 +188,246 @@ class VideoGenerator:
             return class_match.group(1)
         return "MathAnimation"  # Default class name
         
-    def generate_video(self, math_topic, audience_level="high school", user_feedback=None):
-        """Generate a Manim animation video for the given math topic using the complete workflow"""
-        print(f"Starting complete workflow for topic: {math_topic}")
+    def _artifacts_dir(self, math_topic):
+        artifacts_dir = os.path.join(self.videos_dir, f"{self._get_safe_filename(math_topic)}_artifacts")
+        os.makedirs(artifacts_dir, exist_ok=True)
+        return artifacts_dir
+    
+    def _save_checkpoint(self, math_topic, stage, result):
+        """Write a finished stage to the artifacts directory straight away.
         
-        # Step 1: Analyze the concept
-        print("Step 1/5: Analyzing mathematical concept...")
-        concept_results = self.generator.analyze_concept(math_topic, audience_level)
+        result is a stage results dict (its full_response is saved) or, for the
+        code stage, the code itself.
+        """
+        text = result.get("full_response") if isinstance(result, dict) else result
+        if not text:
+            return
+        artifacts_dir = self._artifacts_dir(math_topic)
+        path = os.path.join(artifacts_dir, STAGE_CHECKPOINTS[stage])
         
-        if not concept_results:
-            print("Failed to analyze concept.")
-            return False
-            
-        concept_analysis = concept_results.get("concept_analysis", "")
-        print("Concept analysis completed successfully!")
-        
-        # Step 2: Design the animation
-        print("\nStep 2/5: Generating animation design...")
-        design_results = self.generator.design_scene(
-            math_topic, 
-            audience_level, 
-            concept_analysis
+        # Later stages were built on the result being replaced, so they must not be resumed from
+        stages = list(STAGE_CHECKPOINTS)
+        for later in stages[stages.index(stage) + 1:]:
+            _remove_if_exists(os.path.join(artifacts_dir, STAGE_CHECKPOINTS[later]))
+        
+        # Write to a temp file first so an interrupted run never leaves a truncated checkpoint
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        print(f"Checkpointed {stage} stage to {path}")
+    
+    def _load_checkpoints(self, math_topic, audience_level, user_feedback=None):
+        """Return the results of the checkpointed stages to skip when resuming.
+        
+        Checkpoints made for another audience level or feedback are deleted, so
+        neither this run nor a later one resumes from them. Stages are read in
+        pipeline order up to the first missing one; saving a stage deletes the
+        checkpoints after it, so a re-run stage never feeds into a stale one.
+        """
+        artifacts_dir = self._artifacts_dir(math_topic)
+        run = {
+            "audience_level": audience_level,
+            "user_feedback": hashlib.sha256(user_feedback.encode()).hexdigest() if user_feedback else None,
+        }
+        run_path = os.path.join(artifacts_dir, RUN_CHECKPOINT)
+        try:
+            with open(run_path, 'r') as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            # Artifacts from before runs were recorded are taken to match
+            previous = None
+        if previous != run:
+            if previous is not None:
+                print(f"Checkpoints of '{math_topic}' were made for another audience or feedback; discarding them")
+                for filename in STAGE_CHECKPOINTS.values():
+                    _remove_if_exists(os.path.join(artifacts_dir, filename))
+            tmp_path = f"{run_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(run, f)
+            os.replace(tmp_path, run_path)
+        
+        resumed = {}
+        if not self.resume:
+            return resumed
+        
+        parsers = {
+            "concept": self.generator._parse_concept,
+            "design": self.generator._parse_design,
+            "testing": self.generator._parse_testing,
+            "code": lambda code: code,
+        }
+        for stage, filename in STAGE_CHECKPOINTS.items():
+            path = os.path.join(artifacts_dir, filename)
+            try:
+                with open(path, 'r') as f:
+                    text = f.read()
+            except OSError:
+                break
+            if not text.strip():
+                break
+            print(f"Resuming {stage} stage from {path}")
+            resumed[stage] = parsers[stage](text)
+        return resumed
+    
+    def _finish_run(self, math_topic, saved, metrics):
+        """Save the run's metrics next to its artifacts and build its VideoResult"""
+        summary = metrics.summary()
+        metrics.save(os.path.join(self._artifacts_dir(math_topic), "metrics.json"))
+        print(format_summary(summary))
+        
+        if not saved:
+            return VideoResult(False, None, None, summary, None)
+        return VideoResult(True, saved.video_path, self._code_path(math_topic), summary,
+                           self._schedule_upgrade(math_topic, saved))
+    
+    def _schedule_upgrade(self, math_topic, saved):
+        """Re-render a saved preview's code at final_quality in the background.
+        
+        The code is rendered from a copy taken now, so a later run of the topic
+        rewriting generated_<topic>.py cannot change what is rendered. The
+        preview is replaced atomically once the render finishes, so whatever
+        serves the file never sees a partial video. Returns a Future that
+        resolves to the video path when it has been upgraded, or to None if the
+        render failed or a newer run of the topic has saved its preview since.
+        """
+        if not self.final_quality:
+            return None
+        
+        video_path, generation = saved.video_path, saved.generation
+        upgrades_dir = os.path.join(self.code_dir, "upgrades")
+        os.makedirs(upgrades_dir, exist_ok=True)
+        filepath = os.path.join(
+            upgrades_dir, f"generated_{self._get_safe_filename(math_topic)}_{os.getpid()}_{generation}.py"
         )
+        with open(filepath, 'w') as file:
+            file.write(saved.code)
+        media_dir = self._media_dir(filepath)
         
-        if not design_results:
-            print("Failed to generate design.")
-            return False
-            
-        animation_design = design_results.get("animation_design", "")
-        print("Animation design generated successfully!")
-        
-        # Step 3: Test the animation design
-        print("\nStep 3/5: Testing animation design for improvements...")
-        test_results = self.generator.test_animation_design(
-            math_topic,
-            animation_design
+        upgrade = concurrent.futures.Future()
+        
+        def finish(render):
+            # The render was written to output_path; its play() calls live on in the partial movie cache
+            _remove_if_exists(filepath)
+            shutil.rmtree(media_dir, ignore_errors=True)
+            try:
+                source_path, error = render.result()
+                if not source_path:
+                    print(f"[{math_topic}] {self.final_quality} render failed; keeping the preview"
+                          + (f": {error.strip().splitlines()[-1]}" if error else ""))
+                    upgrade.set_result(None)
+                    return
+                with self._upgrade_lock:
+                    if self._upgrade_generations.get(math_topic) != generation:
+                        print(f"[{math_topic}] Discarding {self.final_quality} render of outdated code")
+                        os.remove(source_path)
+                        upgrade.set_result(None)
+                        return
+                    os.replace(source_path, video_path)
+                print(f"[{math_topic}] Replaced the preview with the {self.final_quality} render: {video_path}")
+                upgrade.set_result(video_path)
+            except BaseException as e:
+                print(f"[{math_topic}] {self.final_quality} upgrade failed: {e}")
+                if not upgrade.done():
+                    upgrade.set_result(None)
+        
+        submit = self.render_pool.submit_segmented if self.segmented_render else self.render_pool.submit
+        render = submit(
+            filepath,
+            self._extract_class_name(saved.code),
+            media_dir,
+            quality=self.final_quality,
+            owner=self._code_path(math_topic),
+            background=True,
+            output_path=self._render_path(math_topic)
         )
+        render.add_done_callback(finish)
+        print(f"[{math_topic}] Preview ready; {self.final_quality} render queued in the background")
+        return upgrade
+    
+    def generate_video(self, math_topic, audience_level="high school", user_feedback=None):
+        """Generate a Manim animation video for the given math topic using the complete workflow.
+        
+        Returns a VideoResult. Its metrics are also saved as metrics.json in the
+        topic's artifacts directory. Several topics can be generated at once from
+        different threads; runs share no per-call state on the generator.
+        """
+        metrics = PipelineMetrics(math_topic)
+        token = start_tracking(metrics)
+        try:
+            saved = self._run_pipeline(math_topic, audience_level, user_feedback)
+        finally:
+            stop_tracking(token)
+        return self._finish_run(math_topic, saved, metrics)
+    
+    def _run_pipeline(self, math_topic, audience_level, user_feedback=None):
+        """Run every stage for one topic; returns _save_video's result or False"""
+        print(f"Starting complete workflow for topic: {math_topic}")
+        resumed = self._load_checkpoints(math_topic, audience_level, user_feedback)
+        
+        if self.fused:
+            if "testing" in resumed:
+                concept_results, design_results, test_results = (
+                    resumed["concept"], resumed["design"], resumed["testing"]
+                )
+            else:
+                # Steps 1-3 in a single round trip
+                print("Steps 1-3/5: Analyzing, designing and testing in one call...")
+                concept_results, design_results, test_results = self.generator.analyze_and_design(
+                    math_topic,
+                    audience_level
+                )
+                self._save_checkpoint(math_topic, "concept", concept_results)
+                self._save_checkpoint(math_topic, "design", design_results)
+                self._save_checkpoint(math_topic, "testing", test_results)
+            
+            animation_design = design_results.get("animation_design")
+            if not animation_design:
+                print("Failed to generate design.")
+                return False
+            print("Fused analysis and design completed successfully!")
+        else:
+            # Step 1: Analyze the concept
+            concept_results = resumed.get("concept")
+            if concept_results is None:
+                print("Step 1/5: Analyzing mathematical concept...")
+                concept_results = self.generator.analyze_concept(math_topic, audience_level)
+                
+                if not concept_results:
+                    print("Failed to analyze concept.")
+                    return False
+                self._save_checkpoint(math_topic, "concept", concept_results)
+            
+            concept_analysis = concept_results.get("concept_analysis", "")
+            print("Concept analysis completed successfully!")
+            
+            # Step 2: Design the animation
+            design_results = resumed.get("design")
+            if design_results is None:
+                print("\nStep 2/5: Generating animation design...")
+                design_results = self.generator.design_scene(
+                    math_topic, 
+                    audience_level, 
+                    concept_analysis
+                )
+                
+                if not design_results:
+                    print("Failed to generate design.")
+                    return False
+                self._save_checkpoint(math_topic, "design", design_results)
+            
+            animation_design = design_results.get("animation_design", "")
+            print("Animation design generated successfully!")
+            
+            # Step 3: Test the animation design
+            test_results = resumed.get("testing")
+            if test_results is None:
+                print("\nStep 3/5: Testing animation design for improvements...")
+                test_results = self.generator.test_animation_design(
+                    math_topic,
+                    animation_design
+                )
+                self._save_checkpoint(math_topic, "testing", test_results)
         
         if not test_results:
             print("Failed to test animation design. Proceeding with original design.")
@@ -74,24 +437,192 @@ class VideoGenerator:
             print("Design testing completed successfully!")
         
         # Step 4: Generate code based on enhanced design
-        print("\nStep 4/5: Generating Manim code...")
+        code = resumed.get("code")
+        if code is None:
+            print("\nStep 4/5: Generating Manim code...")
+            enhanced_design = animation_design
+            if design_improvements:
+                enhanced_design = animation_design + "\n\n" + design_improvements
+            
+            code_result = self.generator.generate_code(enhanced_design, math_topic)
+            
+            if not code_result:
+                print("Failed to generate code.")
+                return False
+            
+            # Extract just the code part from the result
+            code = code_result.get("code", "")
+            if not code:
+                print("No code found in generator response.")
+                return False
+            self._save_checkpoint(math_topic, "code", code)
+        
+        return self._render_and_save(math_topic, code)
+    
+    async def generate_video_async(self, math_topic, audience_level, generator, user_feedback=None):
+        """Async counterpart of generate_video driven by an AsyncManimGenerator.
+        
+        The LLM stages of many topics overlap, and their renders run in parallel
+        on the render pool.
+        """
+        metrics = PipelineMetrics(math_topic)
+        token = start_tracking(metrics)
+        try:
+            saved = await self._run_pipeline_async(math_topic, audience_level, generator, user_feedback)
+        finally:
+            stop_tracking(token)
+        return self._finish_run(math_topic, saved, metrics)
+    
+    async def _run_pipeline_async(self, math_topic, audience_level, generator, user_feedback=None):
+        print(f"Starting async workflow for topic: {math_topic}")
+        resumed = self._load_checkpoints(math_topic, audience_level, user_feedback)
+        
+        if self.fused:
+            if "testing" in resumed:
+                concept_results, design_results, test_results = (
+                    resumed["concept"], resumed["design"], resumed["testing"]
+                )
+            else:
+                concept_results, design_results, test_results = await generator.analyze_and_design(
+                    math_topic,
+                    audience_level
+                )
+                self._save_checkpoint(math_topic, "concept", concept_results)
+                self._save_checkpoint(math_topic, "design", design_results)
+                self._save_checkpoint(math_topic, "testing", test_results)
+            animation_design = design_results.get("animation_design")
+            if not animation_design:
+                print(f"[{math_topic}] Failed to generate design.")
+                return False
+        else:
+            concept_results = resumed.get("concept")
+            if concept_results is None:
+                concept_results = await generator.analyze_concept(math_topic, audience_level)
+                if not concept_results:
+                    print(f"[{math_topic}] Failed to analyze concept.")
+                    return False
+                self._save_checkpoint(math_topic, "concept", concept_results)
+            
+            design_results = resumed.get("design")
+            if design_results is None:
+                design_results = await generator.design_scene(
+                    math_topic,
+                    audience_level,
+                    concept_results.get("concept_analysis", "")
+                )
+                if not design_results:
+                    print(f"[{math_topic}] Failed to generate design.")
+                    return False
+                self._save_checkpoint(math_topic, "design", design_results)
+            animation_design = design_results.get("animation_design", "")
+            
+            test_results = resumed.get("testing")
+            if test_results is None:
+                test_results = await generator.test_animation_design(math_topic, animation_design)
+                self._save_checkpoint(math_topic, "testing", test_results)
+        design_improvements = test_results.get("improvements", "") if test_results else ""
+        
         enhanced_design = animation_design
         if design_improvements:
             enhanced_design = animation_design + "\n\n" + design_improvements
         
-        code_result = self.generator.generate_code(enhanced_design, math_topic)
-
+        code = resumed.get("code")
+        if code is None and self.candidates > 1:
+            code, source_path = await self._race_candidates(generator, enhanced_design, math_topic)
+            if not code:
+                return False
+            self._save_checkpoint(math_topic, "code", code)
+            
+            # Keep the winning code where the single-candidate path would have written it
+            filepath = self._code_path(math_topic)
+            with open(filepath, 'w') as file:
+                file.write(code)
+            return self._save_video(math_topic, source_path, code)
+        
+        if code is None:
+            code_result = await generator.generate_code(enhanced_design, math_topic)
+            code = code_result.get("code", "") if code_result else ""
+            if not code:
+                print(f"[{math_topic}] No code found in generator response.")
+                return False
+            self._save_checkpoint(math_topic, "code", code)
         
-        if not code_result:
-            print("Failed to generate code.")
+        filepath = self._write_code(math_topic, code)
+        output_path = self._render_path(math_topic)
+        try:
+            for attempt in range(self.render_fixes + 1):
+                source_path, error = await asyncio.to_thread(self._render_code, filepath, code, output_path)
+                if source_path:
+                    return self._save_video(math_topic, source_path, code)
+                if error is None or attempt == self.render_fixes:
+                    return False
+                
+                fix = await generator.fix_render_error(code, error, math_topic)
+                code = self._apply_render_fix(math_topic, filepath, code, error, fix, attempt + 1)
+                if not code:
+                    return False
             return False
-            
-        # Extract just the code part from the result
-        code = code_result.get("code", "")
-        if not code:
-            print("No code found in generator response.")
+        finally:
+            _remove_if_exists(output_path)
+    
+    async def generate_videos(self, topics, audience_level="high school", concurrency=4, user_feedback=None):
+        """Generate videos for several topics concurrently.
+        
+        At most `concurrency` topics are in flight at once. Returns one
+        VideoResult per topic, in the same order, as generate_video does;
+        user_feedback applies to every topic.
+        """
+        generator = AsyncManimGenerator(
+            api_key=self.api_key,
+            cache=self.generator.cache,
+            streaming=self.generator.streaming,
+            rate_limiter=self.rate_limiter,
+            token_budget=self.generator.token_budget,
+            client=self.llm_backend.async_client() if self.llm_backend else None
+        )
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run(topic):
+            async with semaphore:
+                try:
+                    return await self.generate_video_async(topic, audience_level, generator, user_feedback)
+                except Exception as e:
+                    print(f"Error generating video for '{topic}': {e}")
+                    return VideoResult(False, None, None, None, None)
+        
+        try:
+            return await asyncio.gather(*(run(topic) for topic in topics))
+        finally:
+            await generator.close()
+    
+    def _render_and_save(self, math_topic, code):
+        """Save the generated code and render it with Manim straight into videos_dir.
+        
+        When Manim fails, up to self.render_fixes patches of the code are requested
+        from the generator and the render is retried.
+        """
+        filepath = self._write_code(math_topic, code)
+        output_path = self._render_path(math_topic)
+        
+        try:
+            for attempt in range(self.render_fixes + 1):
+                source_path, error = self._render_code(filepath, code, output_path)
+                if source_path:
+                    return self._save_video(math_topic, source_path, code)
+                if error is None or attempt == self.render_fixes:
+                    return False
+                
+                # Ask for a minimal patch of the failing code and render again
+                fix = self.generator.fix_render_error(code, error, math_topic)
+                code = self._apply_render_fix(math_topic, filepath, code, error, fix, attempt + 1)
+                if not code:
+                    return False
             return False
-            
+        finally:
+            _remove_if_exists(output_path)
+    
+    def _write_code(self, math_topic, code):
+        """Save the generated code as generated_<topic>.py in code_dir; returns its path"""
         print("Code generated successfully!")
 
         print(f"Generated code for '{math_topic}':")
@@ -106,110 +637,223 @@ class VideoGenerator:
             print(f"WARNING: Generated code might not match topic '{math_topic}'!")
         
         # Save code as a file
-        safe_topic = self._get_safe_filename(math_topic)
-        filename = f"generated_{safe_topic}.py"
-        filepath = os.path.join(self.code_dir, filename)
-        
+        filepath = self._code_path(math_topic)
         with open(filepath, 'w') as file:
             file.write(code)
         
-        # Save code path as instance attribute for easy access later
-        self.code_path = filepath
         print(f"Code saved to {filepath}")
+        return filepath
+    
+    def _render_code(self, filepath, code, output_path=None):
+        """Render filepath with Manim into output_path.
         
+        Returns (video_path, None) on success and (None, error) when the static
+        check, the dry run or Manim fails, or (None, None) when the failure is not something
+        a code fix can address.
+        """
         # Extract the class name for running Manim
         class_name = self._extract_class_name(code)
         print(f"Detected class name: {class_name}")
         
-        # Run Manim on the generated file
+        # Problems found statically are reported like a Manim error, without a render
+        problems = self._check_code(code, class_name)
+        if problems:
+            return None, problems
+        
+        # Errors construct() raises are reported without spending a render on them
+        num_plays = None
+        if self.dry_run:
+            check = self.render_pool.dry_run(filepath, class_name, owner=filepath,
+                                             media_dir=self._media_dir(filepath))
+            error = self._dry_run_error(class_name, check)
+            if error:
+                return None, error
+            num_plays = check["num_plays"] if check else None
+        
+        # Rendered by the pool, in a warm worker unless Manim is missing here
+        print(f"Running Manim animation...")
+        temp_media_dir = self._media_dir(filepath)
+        os.makedirs(temp_media_dir, exist_ok=True)
+        if self.segmented_render:
+            video_path, error = self.render_pool.render_segmented(filepath, class_name, temp_media_dir,
+                                                                  owner=filepath, num_plays=num_plays,
+                                                                  output_path=output_path)
+        else:
+            video_path, error = self.render_pool.render(filepath, class_name, temp_media_dir, owner=filepath,
+                                                        output_path=output_path)
+        if error:
+            print(f"Manim error: {error}")
+        return video_path, error
+    
+    def _dry_run_error(self, class_name, check):
+        """Report a dry run's result; returns the error that should stop the render, or None"""
+        if check is None:
+            # Manim could not run here at all; say so once rather than on every render
+            if not self._dry_run_unavailable.is_set():
+                self._dry_run_unavailable.set()
+                print("Dry-run gate disabled for this run: Manim could not be started for a dry run")
+            return None
+        if check["error"]:
+            print(f"Dry run failed; skipping the render:\n{check['error']}")
+            return check["error"]
+        num_plays = check["num_plays"]
+        if num_plays == 0:
+            error = (f"{class_name}.construct() made no self.play() or self.wait() calls, "
+                     "so the video would be empty")
+            print(f"Dry run: {error}")
+            return error
+        if num_plays is None:
+            print("Dry run passed")
+            return None
+        duration = f", {check['duration']:.1f}s" if check["duration"] is not None else ""
+        print(f"Dry run passed: {num_plays} play() calls{duration}")
+        return None
+    
+    def _check_code(self, code, class_name):
+        """Statically check code before rendering; returns a problem report or None"""
+        if self.api_index is None:
+            return None
+        check = check_scene(code, class_name, self.api_index)
+        if check["ok"]:
+            return None
+        print(f"Static check found {len(check['problems'])} problem(s); skipping the render:")
+        for problem in check["problems"]:
+            print(f"  {problem}")
+        return format_problems(check)
+    
+    def _apply_render_fix(self, math_topic, filepath, code, error, fix, attempt):
+        """Apply a render fix to the code file and save the diff in the artifacts.
+        
+        Returns the patched code, or None if the fix could not be applied.
+        """
+        patched_code = fix.get("code") if fix else None
+        if not patched_code or patched_code == code:
+            print(f"Render fix {attempt} produced no applicable patch.")
+            return None
+        
+        # Generated code has no trailing newline; add one so the diff lines stay separate
+        diff = difflib.unified_diff(
+            (code.rstrip("\n") + "\n").splitlines(keepends=True),
+            (patched_code.rstrip("\n") + "\n").splitlines(keepends=True),
+            fromfile=f"{os.path.basename(filepath)} (before fix {attempt})",
+            tofile=f"{os.path.basename(filepath)} (after fix {attempt})"
+        )
+        # Keep the end of the error above the diff so the fix can be reviewed in context
+        error_lines = error.strip().splitlines()[-20:]
+        diff_path = os.path.join(self._artifacts_dir(math_topic), f"05_render_fix_{attempt}.diff")
+        with open(diff_path, 'w') as f:
+            f.writelines(f"# {line}\n" for line in error_lines)
+            f.writelines(diff)
+        print(f"Render fix {attempt} applied; diff saved to {diff_path}")
+        
+        with open(filepath, 'w') as file:
+            file.write(patched_code)
+        self._save_checkpoint(math_topic, "code", patched_code)
+        return patched_code
+    
+    def _save_video(self, math_topic, source_path, code):
+        """Rename a video rendered from code to the topic's name in videos_dir, replacing any earlier one.
+        
+        Starts a new generation of the topic's video in the same step, so an
+        upgrade still running for an earlier preview can no longer replace it.
+        Returns a _SavedVideo with that generation.
+        """
+        target_path = self._video_path(math_topic)
+        
+        with self._upgrade_lock:
+            generation = self._upgrade_generations.get(math_topic, 0) + 1
+            self._upgrade_generations[math_topic] = generation
+            # source_path is on the same file system, so this is a rename and never a copy
+            os.replace(source_path, target_path)
+        print(f"Animation saved to {target_path}")
+        return _SavedVideo(target_path, generation, code)
+    
+    async def _render_candidate(self, code, filepath, media_dir):
+        """Validate and render one code candidate; returns the rendered mp4 path or None.
+        
+        Each candidate is its own owner on the render pool, so candidates share
+        the workers with each other and with other topics, and renders into a
+        media directory of its own. The video is written to candidate.mp4 in
+        that directory. Cancelling the coroutine cancels the candidate's queued
+        jobs; a render that has already started runs to the end.
+        """
         try:
-            print(f"Running Manim animation...")
-            
-            # Create a temp directory for Manim output
-            temp_media_dir = os.path.join(self.code_dir, "media")
-            os.makedirs(temp_media_dir, exist_ok=True)
-            
-            # Change to the code directory to run manim
-            original_dir = os.getcwd()
-            os.chdir(self.code_dir)
-            
-            # Run Manim with low quality for speed (-ql) and preview (-p)
-            result = subprocess.run(
-                ['manim', '-ql', filepath, class_name],
-                capture_output=True, 
-                text=True
+            compile(code, filepath, 'exec')
+        except SyntaxError as e:
+            print(f"Candidate {os.path.basename(filepath)} rejected: {e}")
+            return None
+        class_name = self._extract_class_name(code)
+        if self._check_code(code, class_name):
+            print(f"Candidate {os.path.basename(filepath)} rejected by the static check")
+            return None
+        
+        with open(filepath, 'w') as file:
+            file.write(code)
+        os.makedirs(media_dir, exist_ok=True)
+        output_path = os.path.join(os.path.abspath(media_dir), "candidate.mp4")
+        
+        # Cancelling the awaited asyncio future cancels the pool's Future as well
+        if self.dry_run:
+            check = await asyncio.wrap_future(
+                self.render_pool.submit_dry_run(filepath, class_name, owner=filepath, media_dir=media_dir)
             )
-            
-            if result.returncode != 0:
-                print(f"Manim error: {result.stderr}")
-                os.chdir(original_dir)
-                return False
-                
-            # Find the generated video file
-            video_pattern = r"File ready at '(.*?)'"
-            match = re.search(video_pattern, result.stdout)
-            
-            if not match:
-                # Look in the media directory for the most recent mp4 file
-                media_videos_dir = os.path.join(temp_media_dir, "videos", os.path.basename(filepath).replace('.py', ''), "480p15")
-                if os.path.exists(media_videos_dir):
-                    mp4_files = [f for f in os.listdir(media_videos_dir) if f.endswith('.mp4')]
-                    if mp4_files:
-                        # Sort by creation time, newest first
-                        mp4_files.sort(key=lambda x: os.path.getctime(os.path.join(media_videos_dir, x)), reverse=True)
-                        source_path = os.path.join(media_videos_dir, mp4_files[0])
-                    else:
-                        print("No MP4 files found in the media directory.")
-                        os.chdir(original_dir)
-                        return False
-                else:
-                    print(f"Media videos directory not found: {media_videos_dir}")
-                    os.chdir(original_dir)
-                    return False
-            else:
-                source_path = match.group(1)
-            
-            # Copy the video to the videos directory with a descriptive name
-            target_filename = f"{safe_topic}_animation.mp4"
-            target_path = os.path.join(self.videos_dir, target_filename)
-            
-            shutil.copy2(source_path, target_path)
-            print(f"Animation saved to {target_path}")
-            
-            # Save video path as instance attribute
-            self.video_path = target_path
-            
-            # Save workflow artifacts for future reference
-            artifacts_dir = os.path.join(self.videos_dir, f"{safe_topic}_artifacts")
-            os.makedirs(artifacts_dir, exist_ok=True)
-            
-            # Save concept analysis
-            with open(os.path.join(artifacts_dir, "01_concept_analysis.txt"), 'w') as f:
-                f.write(concept_results.get("full_response", ""))
-                
-            # Save design
-            with open(os.path.join(artifacts_dir, "02_animation_design.txt"), 'w') as f:
-                f.write(design_results.get("full_response", ""))
-                
-            # Save testing results
-            if test_results:
-                with open(os.path.join(artifacts_dir, "03_design_testing.txt"), 'w') as f:
-                    f.write(test_results.get("full_response", ""))
-            
-            # Save code generation
-            with open(os.path.join(artifacts_dir, "04_code.py"), 'w') as f:
-                f.write(code)
-                
-            print(f"Workflow artifacts saved to {artifacts_dir}")
-            
-            # Change back to original directory
-            os.chdir(original_dir)
-            
-            return target_path
-            
-        except Exception as e:
-            print(f"Error running Manim: {e}")
-            # Make sure we return to the original directory
-            if 'original_dir' in locals():
-                os.chdir(original_dir)
-            return False
\ No newline at end of file
+            if self._dry_run_error(class_name, check):
+                print(f"Candidate {os.path.basename(filepath)} rejected by the dry run")
+                return None
+        video_path, error = await asyncio.wrap_future(
+            self.render_pool.submit(filepath, class_name, media_dir, owner=filepath, output_path=output_path)
+        )
+        if not video_path:
+            print(f"Candidate {os.path.basename(filepath)} failed to render: {(error or 'crashed or timed out')[-500:]}")
+            return None
+        return video_path
+    
+    async def _race_candidates(self, generator, design, math_topic):
+        """Generate self.candidates code candidates in parallel and keep the first that renders.
+        
+        Returns (code, rendered_mp4_path), or (None, None) if every candidate fails.
+        The remaining candidates are cancelled as soon as one succeeds.
+        """
+        candidates_dir = os.path.join(self.code_dir, f"{self._get_safe_filename(math_topic)}_candidates")
+        os.makedirs(candidates_dir, exist_ok=True)
+        
+        async def attempt(index):
+            try:
+                code_result = await generator.generate_code(design, math_topic, variant=index)
+                code = code_result.get("code", "") if code_result else ""
+                if not code:
+                    return None
+                source_path = await self._render_candidate(
+                    code,
+                    os.path.join(candidates_dir, f"candidate_{index}.py"),
+                    os.path.join(candidates_dir, f"media_{index}")
+                )
+                return (index, code, source_path) if source_path else None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"[{math_topic}] Candidate {index} failed: {e}")
+                return None
+        
+        tasks = [asyncio.create_task(attempt(index)) for index in range(self.candidates)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                if result:
+                    index, code, source_path = result
+                    print(f"[{math_topic}] Candidate {index} rendered first; cancelling the rest")
+                    return code, source_path
+            print(f"[{math_topic}] All {self.candidates} code candidates failed.")
+            return None, None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _remove_if_exists(path):
+    """Delete a render's output file left behind by a failed or abandoned run"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
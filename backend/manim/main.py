@@ -1,50 +1,23 @@
 from dotenv import load_dotenv
 import os
 import argparse
+import asyncio
+import concurrent.futures
 import requests
 import json
 import re
 from generate_video import VideoGenerator
+from replay import ReplayBackend
 
-def main():
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser(description="Generate Manim animations for math concepts")
-    parser.add_argument("--topic", type=str, required=True, help="Mathematical topic to animate")
-    parser.add_argument("--audience", type=str, default="high school", 
-                      help="Target audience level (e.g., elementary, middle school, high school, undergraduate)")
-    parser.add_argument("--feedback", type=str, default=None, 
-                      help="Path to a text file containing user feedback for improving an existing animation")
-    parser.add_argument("--server-url", type=str, default="http://localhost:4000", 
-                      help="URL of the Node.js server")
-    args = parser.parse_args()
-    
-    print(f"Server URL: {args.server_url}")
-    
-    # Load environment variables from .env file
-    load_dotenv()
-    api_key = os.getenv('ANTHROPIC_API_KEY')
-    
-    if not api_key:
-        print("Error: ANTHROPIC_API_KEY not found in environment variables")
-        print("Please create a .env file with your API key or set it as an environment variable")
-        return
-    
-    # Initialize the video generator
-    video_gen = VideoGenerator(api_key=api_key)
-    
-    # Process user feedback if provided
-    user_feedback = None
-    if args.feedback and os.path.exists(args.feedback):
-        try:
-            with open(args.feedback, 'r') as feedback_file:
-                user_feedback = feedback_file.read()
-            print(f"Loaded user feedback from {args.feedback}")
-        except Exception as e:
-            print(f"Error reading feedback file: {e}")
-    
-    # Generate the video with complete workflow
-    result = video_gen.generate_video(args.topic, args.audience, user_feedback)
-    success = isinstance(result, str) 
+# Manim config quality for each --final-quality choice
+FINAL_QUALITIES = {"none": None, "high": "high_quality", "4k": "fourk_quality"}
+
+# Recorded runs that --replay uses when no directory is given
+DEFAULT_REPLAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "content", "videos_dir")
+
+def save_result(args, video_gen, topic, result, user_feedback):
+    """Save one topic's result to MongoDB via the Express server and report it"""
+    success = result.success
     
     # Save result to MongoDB via the Express server
     try:
@@ -53,11 +26,8 @@ def main():
         video_path = ""
         
         if success:
-            # Extract the code filename from the video path
-            video_path = result
-            safe_topic = os.path.basename(video_path).replace('_animation.mp4', '')
-            code_filename = f"generated_{safe_topic}.py"
-            code_path = os.path.join(video_gen.code_dir, code_filename)
+            video_path = result.video_path
+            code_path = result.code_path
             
             if os.path.exists(code_path):
                 with open(code_path, 'r') as file:
@@ -80,12 +50,14 @@ def main():
             
         # Prepare data to send to the server
         data = {
-            "topic": args.topic,
+            "topic": topic,
             "audience": args.audience,
             "code": code_content,
             "status": "completed" if success else "failed",
             "videoPath": video_path if success and os.path.exists(video_path) else "",
-            "hasFeedback": user_feedback is not None
+            "hasFeedback": user_feedback is not None,
+            # A final-quality render replaces the preview later (see notify_upgrade)
+            "quality": "preview" if result.upgrade else "final"
         }
         
         endpoint_url = f"{args.server_url}/videos/save-from-python"
@@ -126,13 +98,179 @@ def main():
     
     # Display completion message
     if success:
-        print(f"\nProcess completed for topic: '{args.topic}'")
+        print(f"\nProcess completed for topic: '{topic}'")
         print(f"Code saved to: {video_gen.code_dir}")
         print(f"Artifacts saved to: {os.path.join(video_gen.videos_dir, os.path.basename(video_path).replace('_animation.mp4', '') + '_artifacts')}")
-        if isinstance(result, str):
-            print(f"Video saved to: {result}")
+        print(f"Video saved to: {video_path}")
     else:
-        print(f"\nFailed to complete the process for topic: '{args.topic}'")
+        print(f"\nFailed to complete the process for topic: '{topic}'")
+
+def notify_upgrade(args, topic, video_path):
+    """Tell the Express server that a topic's preview was replaced by its final render"""
+    endpoint_url = f"{args.server_url}/videos/upgrade-from-python"
+    try:
+        response = requests.post(
+            endpoint_url,
+            json={"topic": topic, "videoPath": video_path, "quality": "final"},
+            headers={"Content-Type": "application/json"},
+            timeout=30
+        )
+        if response.status_code == 200:
+            print(f"Server now serves the final-quality video for '{topic}'")
+        else:
+            print(f"Failed to report the final-quality video for '{topic}'. Status code: {response.status_code}")
+            print(f"Response: {response.text}")
+    except requests.exceptions.RequestException as e:
+        print(f"Could not report the final-quality video for '{topic}': {e}")
+
+def wait_for_upgrades(args, topics, results):
+    """Report each background final-quality render to the server as it finishes"""
+    upgrades = {}
+    for topic, result in zip(topics, results):
+        if result.upgrade:
+            upgrades[result.upgrade] = topic
+    if not upgrades:
+        return
+    
+    print(f"\nWaiting for {len(upgrades)} final-quality render(s); previews are already available")
+    for upgrade in concurrent.futures.as_completed(upgrades):
+        video_path = upgrade.result()
+        if video_path:
+            notify_upgrade(args, upgrades[upgrade], video_path)
+
+def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Generate Manim animations for math concepts")
+    parser.add_argument("--topic", type=str, nargs="+", required=True,
+                      help="Mathematical topic(s) to animate; several topics are generated concurrently")
+    parser.add_argument("--audience", type=str, default="high school", 
+                      help="Target audience level (e.g., elementary, middle school, high school, undergraduate)")
+    parser.add_argument("--feedback", type=str, default=None, 
+                      help="Path to a text file containing user feedback for improving an existing animation")
+    parser.add_argument("--server-url", type=str, default="http://localhost:4000", 
+                      help="URL of the Node.js server")
+    parser.add_argument("--no-cache", action="store_true",
+                      help="Always call the API instead of reusing cached responses")
+    parser.add_argument("--cache-only", action="store_true",
+                      help="Offline mode: only use cached responses and never call the API")
+    parser.add_argument("--no-stream", action="store_true",
+                      help="Wait for complete API responses instead of streaming and stopping early")
+    parser.add_argument("--concurrency", type=int, default=4,
+                      help="Maximum number of topics in flight at once when several topics are given")
+    parser.add_argument("--fused", action="store_true",
+                      help="Run concept analysis, design and design testing as one API call instead of three")
+    parser.add_argument("--candidates", type=int, default=1,
+                      help="Generate this many code candidates in parallel and keep the first that renders")
+    parser.add_argument("--resume", action="store_true",
+                      help="Skip stages already checkpointed in the topic's artifacts directory")
+    parser.add_argument("--render-fixes", type=int, default=2,
+                      help="Times to patch the code from the Manim error and re-render before giving up")
+    parser.add_argument("--no-static-check", action="store_true",
+                      help="Launch Manim without first checking the code against the Manim API")
+    parser.add_argument("--no-dry-run", action="store_true",
+                      help="Render without first running construct() with rendering disabled")
+    parser.add_argument("--cold-render", action="store_true",
+                      help="Start a new manim process for every render instead of keeping a warm worker")
+    parser.add_argument("--render-workers", type=int, default=0,
+                      help="Renders to run in parallel, each pinned to its own cores (default: one per CPU core)")
+    parser.add_argument("--render-memory-mb", type=int, default=None,
+                      help="Address space limit for each render worker in MB")
+    parser.add_argument("--render-cpu-seconds", type=int, default=None,
+                      help="CPU time limit for each render in seconds")
+    parser.add_argument("--partial-cache-mb", type=int, default=2048,
+                      help="Size limit of the partial movie cache shared by all renders (0 disables)")
+    parser.add_argument("--segmented", action="store_true",
+                      help="Render each scene as ranges of play() calls on several workers and join them")
+    parser.add_argument("--final-quality", choices=sorted(FINAL_QUALITIES), default="high",
+                      help="Re-render each video at this quality in the background after the -ql preview")
+    parser.add_argument("--max-tokens-percentile", type=float, default=95,
+                      help="Size each stage's max_tokens at this percentile of past response lengths (0 disables)")
+    parser.add_argument("--replay", type=str, nargs="?", const=DEFAULT_REPLAY_DIR, default=None,
+                      help="Replay recorded responses from a directory of *_artifacts instead of calling the API")
+    parser.add_argument("--replay-tps", type=float, default=60.0,
+                      help="Replay speed in output tokens per second (0 for no synthetic latency)")
+    parser.add_argument("--replay-error-rate", type=float, default=0.0,
+                      help="Fraction of replayed requests that fail with a 529 overloaded error")
+    parser.add_argument("--rpm", type=int, default=50,
+                      help="API requests per minute shared by all local processes (0 disables)")
+    parser.add_argument("--tpm", type=int, default=40000,
+                      help="API input tokens per minute shared by all local processes (0 disables)")
+    args = parser.parse_args()
+    
+    print(f"Server URL: {args.server_url}")
+    
+    # Load environment variables from .env file
+    load_dotenv()
+    api_key = os.getenv('ANTHROPIC_API_KEY')
+    
+    if not api_key and not args.cache_only and not args.replay:
+        print("Error: ANTHROPIC_API_KEY not found in environment variables")
+        print("Please create a .env file with your API key or set it as an environment variable")
+        return
+    
+    # Initialize the video generator
+    video_gen = VideoGenerator(
+        api_key=api_key,
+        use_cache=not args.no_cache,
+        cache_only=args.cache_only,
+        streaming=not args.no_stream,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        fused=args.fused,
+        candidates=args.candidates,
+        resume=args.resume,
+        render_fixes=args.render_fixes,
+        max_tokens_percentile=args.max_tokens_percentile,
+        static_check=not args.no_static_check,
+        warm_render=not args.cold_render,
+        render_workers=args.render_workers,
+        render_memory_mb=args.render_memory_mb,
+        render_cpu_seconds=args.render_cpu_seconds,
+        final_quality=FINAL_QUALITIES[args.final_quality],
+        partial_cache_mb=args.partial_cache_mb,
+        segmented_render=args.segmented,
+        dry_run=not args.no_dry_run,
+        llm_backend=ReplayBackend(
+            args.replay,
+            tokens_per_second=args.replay_tps,
+            error_rate=args.replay_error_rate
+        ) if args.replay else None
+    )
+    
+    # Process user feedback if provided
+    user_feedback = None
+    if args.feedback and os.path.exists(args.feedback):
+        try:
+            with open(args.feedback, 'r') as feedback_file:
+                user_feedback = feedback_file.read()
+            print(f"Loaded user feedback from {args.feedback}")
+        except Exception as e:
+            print(f"Error reading feedback file: {e}")
+    
+    # Generate the video(s) with complete workflow
+    try:
+        if len(args.topic) == 1 and args.candidates <= 1:
+            results = [video_gen.generate_video(args.topic[0], args.audience, user_feedback)]
+        else:
+            # Speculative candidates render concurrently, which only the async pipeline does
+            print(f"Generating {len(args.topic)} topics with concurrency {args.concurrency}")
+            results = asyncio.run(
+                video_gen.generate_videos(args.topic, args.audience, args.concurrency, user_feedback)
+            )
+        
+        # Previews are saved right away; final-quality renders continue meanwhile
+        for topic, result in zip(args.topic, results):
+            save_result(args, video_gen, topic, result, user_feedback)
+        wait_for_upgrades(args, args.topic, results)
+    finally:
+        video_gen.close()
+    
+    # Report response cache effectiveness for this run
+    cache = video_gen.generator.cache
+    if cache:
+        stats = cache.stats()
+        print(f"\nResponse cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['entries']} entries ({stats['bytes'] / 1024:.1f} KB)")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import contextvars
+import json
+import threading
+import time
+
+# The metrics collector for the topic currently being generated. A context
+# variable keeps concurrent topics (asyncio tasks or worker threads) separate.
+_current_metrics = contextvars.ContextVar("pipeline_metrics", default=None)
+
+TOKEN_FIELDS = ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens", "output_tokens")
+
+
+class PipelineMetrics:
+    """Per-call token and latency records for one topic, aggregated per stage"""
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.started = time.time()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, **call):
+        with self._lock:
+            self.calls.append({"stage": stage, **call})
+
+    def summary(self):
+        """Aggregate the recorded calls per stage and for the whole topic"""
+        stages = {}
+        for call in self.calls:
+            stage = stages.setdefault(call["stage"], {
+                "calls": 0,
+                "response_cache_hits": 0,
+                "wall_time": 0.0,
+                **{field: 0 for field in TOKEN_FIELDS}
+            })
+            stage["calls"] += 1
+            stage["response_cache_hits"] += 1 if call.get("cached") else 0
+            stage["wall_time"] += call.get("wall_time") or 0.0
+            for field in TOKEN_FIELDS:
+                stage[field] += call.get(field) or 0
+
+        totals = {
+            "calls": len(self.calls),
+            "wall_time": sum(stage["wall_time"] for stage in stages.values()),
+            "elapsed": time.time() - self.started,
+        }
+        for field in TOKEN_FIELDS:
+            totals[field] = sum(stage[field] for stage in stages.values())
+
+        return {
+            "topic": self.topic,
+            "totals": totals,
+            "stages": stages,
+            "calls": list(self.calls),
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def start_tracking(metrics):
+    """Make metrics the collector for the current context; returns a reset token"""
+    return _current_metrics.set(metrics)
+
+
+def stop_tracking(token):
+    _current_metrics.reset(token)
+
+
+def record_call(stage, **call):
+    """Record an LLM call against the current topic, if one is being tracked"""
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.record(stage, **call)
+
+
+def format_summary(summary):
+    """Render a metrics summary as a short per-stage table for the console"""
+    lines = [f"Metrics for '{summary['topic']}':"]
+    lines.append(f"  {'stage':<22}{'calls':>6}{'in':>8}{'cached':>8}{'out':>8}{'wall s':>9}")
+    for name, stage in summary["stages"].items():
+        lines.append(
+            f"  {name:<22}{stage['calls']:>6}{stage['input_tokens']:>8}"
+            f"{stage['cache_read_input_tokens']:>8}{stage['output_tokens']:>8}{stage['wall_time']:>9.1f}"
+        )
+    totals = summary["totals"]
+    lines.append(
+        f"  {'total':<22}{totals['calls']:>6}{totals['input_tokens']:>8}"
+        f"{totals['cache_read_input_tokens']:>8}{totals['output_tokens']:>8}{totals['wall_time']:>9.1f}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,120 @@
+import os
+import shutil
+
+
+class PartialMovieCache:
+    """Content-addressed store of Manim partial movie files shared by all renders.
+
+    Manim names each partial movie file after a hash of the play() call that
+    produced it (camera, animations and mobjects), so a file can be reused by
+    any scene that makes the same call at the same resolution. Files are kept
+    under <cache_dir>/<resolution>/<hash>.<ext>, hard-linked into and out of
+    the render's own partial movie directory where possible, and evicted
+    least recently used first once the store grows past max_bytes.
+
+    Several render processes use the same store; every change is a link or a
+    rename, so readers never see a partial file.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, resolution, name):
+        return os.path.join(self.cache_dir, resolution, name)
+
+    def fetch(self, resolution, name, dest):
+        """Place the cached file for name at dest; returns False if it is not cached"""
+        path = self._path(resolution, name)
+        try:
+            _link_or_copy(path, dest)
+            # The mtime orders eviction, so a hit makes the file recent again
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        except FileExistsError:
+            pass
+        return True
+
+    def add(self, resolution, path):
+        """Store a partial movie file a render produced, unless it is already cached"""
+        cached = self._path(resolution, os.path.basename(path))
+        if os.path.exists(cached):
+            return
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp_path = f"{cached}.{os.getpid()}.tmp"
+        try:
+            _link_or_copy(path, tmp_path)
+            os.replace(tmp_path, cached)
+        except OSError as e:
+            print(f"Could not add {os.path.basename(path)} to the partial movie cache: {e}")
+
+    def add_directory(self, partial_movie_dir):
+        """Store every partial movie file in a scene's partial movie directory.
+
+        The resolution is taken from the directory layout Manim uses,
+        <video_dir>/<resolution>/partial_movie_files/<scene>.
+        """
+        resolution = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(partial_movie_dir))))
+        try:
+            names = os.listdir(partial_movie_dir)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith((".txt", ".tmp")):
+                self.add(resolution, os.path.join(partial_movie_dir, name))
+
+    def evict(self):
+        """Remove the least recently used files until the store fits in max_bytes"""
+        if not self.max_bytes:
+            return 0
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return 0
+
+        # Evict down to 90% so the next few renders do not each trigger a sweep
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        print(f"Partial movie cache: evicted {removed} files, {total / 1024 ** 2:.0f} MB left")
+        return removed
+
+
+def _link_or_copy(source, dest):
+    """Hard-link source to dest, or copy it when the two are on different file systems"""
+    try:
+        os.link(source, dest)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        if isinstance(e, FileNotFoundError) and not os.path.exists(source):
+            raise
+        shutil.copy2(source, dest)
+
+
+def read_partial_movie_list(partial_movie_dir):
+    """Names of the partial movie files Manim combined in its last render of a scene"""
+    try:
+        with open(os.path.join(partial_movie_dir, "partial_movie_file_list.txt"), 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    # Lines look like: file 'file:/path/to/partial_movie_files/Scene/123_456_789.mp4'
+    return [os.path.basename(line.strip()[len("file "):].strip("'")) for line in lines if line.startswith("file ")]
@@ -1,19 +1,26 @@
+import ast
+import functools
+import io
 import re
+import tokenize
+
+# Bump whenever a prompt template changes so cached responses for the old
+# wording are no longer reused
+PROMPT_VERSION = "2"
 
 # =============================================================================
 # Core Prompts for Manim Animation Generation
 # =============================================================================
 
-# Concept analysis prompt - breaking down mathematical concepts for visualization
-CONCEPT_BREAKDOWN = '''You are an AI assistant specializing in breaking down mathematical concepts for visualization. Before designing an animation, you need to analyze the concept and identify the best approach to visualize it.
+# Each prompt is split into a static *_SYSTEM block and a small dynamic user
+# template. The system block is identical for every topic, so it is sent with
+# cache_control and reused from the provider-side prompt cache; only the user
+# template carries the topic-specific content.
 
-<math_topic>
-{topic}
-</math_topic>
+# Concept analysis prompt - breaking down mathematical concepts for visualization
+CONCEPT_BREAKDOWN_SYSTEM = '''You are an AI assistant specializing in breaking down mathematical concepts for visualization. Before designing an animation, you need to analyze the concept and identify the best approach to visualize it.
 
-<audience>
-{audience_level}
-</audience>
+The user will give you the mathematical topic inside <math_topic> tags and the target audience inside <audience> tags.
 
 Analyze this mathematical concept and break it down into visualizable components:
 
@@ -48,20 +55,20 @@ List the specific visual elements that should be included in the animation to ef
 </key_visual_elements>
 '''
 
-# Animation design prompt - creating a description for the animation
-DESIGN = '''You are an AI assistant specialized in creating educational mathematical animations. Your task is to design a 15-second animation explaining a mathematical concept.
-
-Part 1: Animation Design
-
-Here is the mathematical topic you need to cover in your animation:
-
-<math_topic>
+CONCEPT_BREAKDOWN = '''<math_topic>
 {topic}
 </math_topic>
 
 <audience>
 {audience_level}
-</audience>
+</audience>'''
+
+# Animation design prompt - creating a description for the animation
+DESIGN_SYSTEM = '''You are an AI assistant specialized in creating educational mathematical animations. Your task is to design a 15-second animation explaining a mathematical concept.
+
+Part 1: Animation Design
+
+The user will give you the mathematical topic you need to cover inside <math_topic> tags and the target audience inside <audience> tags. A prior analysis of the concept may follow inside <concept_analysis> tags.
 
 Your goal is to create a visually engaging and informative scene that explains this concept. Follow these steps:
 
@@ -128,16 +135,20 @@ Suggest any improvements if necessary.]
 
 Your final output for Part 1 should consist only of the <animation_design> and <self_evaluation> sections, and should not duplicate or rehash any of the work you did in the thinking block.'''
 
-# Animation testing prompt - evaluating the animation design
-ANIMATION_TESTING = '''You are an AI assistant specializing in evaluating mathematical animations. You'll review a proposed animation design and identify potential issues before implementation.
+DESIGN = '''Here is the mathematical topic you need to cover in your animation:
 
 <math_topic>
 {topic}
 </math_topic>
 
-<animation_design>
-{animation_design}
-</animation_design>
+<audience>
+{audience_level}
+</audience>'''
+
+# Animation testing prompt - evaluating the animation design
+ANIMATION_TESTING_SYSTEM = '''You are an AI assistant specializing in evaluating mathematical animations. You'll review a proposed animation design and identify potential issues before implementation.
+
+The user will give you the mathematical topic inside <math_topic> tags and the proposed design inside <animation_design> tags.
 
 Evaluate this animation design by simulating how different viewers would experience it:
 
@@ -174,23 +185,15 @@ Based on your analysis, suggest specific improvements to the animation design:
 </design_improvements>
 '''
 
-CODE_GENERATION = '''You are an expert in creating mathematical animations using the Manim Python library. Your task is to generate code for an animation about the following topic:
-
-<topic>
-{{TOPIC}}
-</topic>
-
-The class name for this animation should be:
-
-<class_name>
-{{SAFE_CLASS_NAME}}
-</class_name>
+ANIMATION_TESTING = '''<math_topic>
+{topic}
+</math_topic>
 
-Here is the design specification for the animation:
+<animation_design>
+{animation_design}
+</animation_design>'''
 
-<design_specification>
-{{design_scene}}
-</design_specification>
+CODE_GENERATION_SYSTEM = '''You are an expert in creating mathematical animations using the Manim Python library. Your task is to generate code for an animation about the topic the user gives you inside <topic> tags, using the class name given inside <class_name> tags and following the design given inside <design_specification> tags.
 
 Before writing the code, please plan out the animation in detail. Wrap your planning process in <animation_planning> tags. In your planning:
 
@@ -224,10 +227,276 @@ Present your response in the following format:
 </code_self_evaluation>
 
 IMPORTANT: The code section MUST start with <CODE_START> and end with <CODE_END> exactly as shown - do not use triple backticks or any markdown formatting. This is critical for the automated system to process your response correctly.'''
+
+CODE_GENERATION = '''Generate code for an animation about the following topic:
+
+<topic>
+{topic}
+</topic>
+
+The class name for this animation should be:
+
+<class_name>
+{safe_class_name}
+</class_name>
+
+Here is the design specification for the animation:
+
+<design_specification>
+{design_scene}
+</design_specification>'''
+
+# Repair prompt - sent when a code generation response cannot be used as-is.
+# Only the failed response is sent back, not the design or the full code
+# generation instructions.
+CODE_REPAIR_SYSTEM = '''You fix Manim code responses that an automated system could not use. The user gives you the topic inside <topic> tags, the required scene class name inside <class_name> tags, what went wrong inside <problem> tags and the previous response inside <previous_response> tags.
+
+Re-emit the code from the previous response with only the changes needed to fix the problem. Do not redesign the animation and do not add planning or evaluation.
+
+Output nothing but the code, wrapped EXACTLY like this:
+
+<CODE_START>
+[The complete, fixed Python code]
+<CODE_END>'''
+
+CODE_REPAIR = '''<topic>
+{topic}
+</topic>
+
+<class_name>
+{safe_class_name}
+</class_name>
+
+<problem>
+{problem}
+</problem>
+
+<previous_response>
+{failed_response}
+</previous_response>'''
+
+# Render fix prompt - sent when Manim fails on generated code. The answer is a
+# set of search/replace patches rather than the whole file.
+RENDER_FIX_SYSTEM = '''You fix Manim Community Edition code that failed to render. The user gives you the scene code inside <code> tags and the error output of the manim command inside <error> tags.
+
+Find the cause of the error and fix it with the smallest possible change. Do not rewrite, restyle or reformat code that works, and do not change what the animation shows.
+
+Answer only with one or more patches in exactly this format:
+
+<PATCH>
+<SEARCH>
+[Lines copied exactly from the current code, including indentation, enough of them to be unique]
+</SEARCH>
+<REPLACE>
+[The lines that replace them]
+</REPLACE>
+</PATCH>
+
+After the last patch write <PATCHES_END>.'''
+
+RENDER_FIX = '''<code>
+{code}
+</code>
+
+<error>
+{error}
+</error>'''
+
+# Fused prompt - concept analysis, animation design and design review in a
+# single round trip. The response uses the same section tags as the staged
+# prompts so the same parsers apply.
+FUSED_ANALYSIS_SYSTEM = '''You are an AI assistant specializing in educational mathematical animations. In a single response you will analyze a mathematical concept, design a 15-second animation that explains it, and then critically review your own design.
+
+The user will give you the mathematical topic inside <math_topic> tags and the target audience inside <audience> tags.
+
+Work through the following three parts in order. Each part builds on the previous one.
+
+Part 1: Concept analysis
+
+<concept_analysis>
+1. Core Definition: [Provide a clear, concise definition of the concept]
+2. Key Components: [List the essential sub-concepts or elements that make up this concept]
+3. Intuitive Understanding: [Describe how this concept can be understood intuitively, using analogies or real-world examples]
+4. Common Misconceptions: [Identify misconceptions or learning obstacles associated with this concept]
+5. Visual Representation Options: [List 3-5 different ways this concept could be visualized, from concrete to abstract]
+6. Progressive Learning Path: [Outline a step-by-step progression for introducing this concept visually]
+</concept_analysis>
+
+<visualization_approach>
+Recommend the most effective approach for visualizing this concept in a 15-second animation and explain why.
+</visualization_approach>
+
+<key_visual_elements>
+List the specific visual elements the animation should include, each with a short justification.
+</key_visual_elements>
+
+Part 2: Animation design
+
+Follow these educational design principles: start with concrete examples before abstract concepts, use visual metaphors that connect to everyday experiences, show both the "what" and the "why", use consistent visual language (colors, shapes) for related concepts, and break complex ideas into sequential, buildable steps. Plan the animation as five 3-second segments.
+
+<animation_design>
+<scene_description>
+[Detailed description of the 15-second animation, including all visual elements and their timing]
+</scene_description>
+
+<mathematical_explanation>
+[Explanation of how the visual elements relate to the mathematical concept]
+</mathematical_explanation>
+
+<key_points>
+[List of the main mathematical ideas conveyed in the animation]
+</key_points>
+
+<intuition_building>
+[Describe specific ways the animation builds intuition about the concept rather than just showing it]
+</intuition_building>
+</animation_design>
+
+<self_evaluation>
+[Evaluate the clarity, visual appeal, educational value and feasibility in MANIM of your design]
+</self_evaluation>
+
+Part 3: Design review
+
+Review the design above as both a novice and an expert viewer would experience it, and check the cognitive load of each segment.
+
+<novice_viewer>
+[Concepts a novice might struggle to follow, confusing visual elements and assumed prior knowledge]
+</novice_viewer>
+
+<expert_viewer>
+[Missing nuances, technical inaccuracies or oversimplifications]
+</expert_viewer>
+
+<cognitive_load_analysis>
+[Moments where too much is presented at once and how to chunk information better]
+</cognitive_load_analysis>
+
+<design_improvements>
+Based on your review, list specific improvements to the animation design:
+1. [Improvement 1]
+2. [Improvement 2]
+3. [Improvement 3]
+...
+</design_improvements>
+
+Output every section above, with its exact tags, in the order shown.'''
+
+FUSED_ANALYSIS = '''<math_topic>
+{topic}
+</math_topic>
+
+<audience>
+{audience_level}
+</audience>'''
+
 # =============================================================================
 # Helper Functions
 # =============================================================================
 
+# Everything the fallback strategies of find_code look for, matched in one
+# left-to-right scan. No pattern
+# can backtrack across more than a single identifier or run of whitespace, so
+# the scan is linear in the length of the response. The lookahead on the first
+# characters of the alternatives lets most positions be skipped in one check.
+_CODE_ANCHORS = re.compile(
+    r'(?=[`fidc\n])(?:'
+    r'(?P<fence>```)'
+    r'|(?P<manim_import>from manim import)'
+    r'|(?P<import>import)'
+    r'|(?P<scene>class\s+\w+\s*\(\s*Scene\s*\))'
+    r'|(?P<construct>def\s+construct\s*\(\s*self\s*\))'
+    r'|\n\n(?P<marker><code_self_evaluation>|---|This code)'
+    r')'
+)
+
+# Text that ends bare (untagged, unfenced) code, in order of preference
+_CODE_END_MARKERS = ("<code_self_evaluation>", "---", "This code")
+
+def find_code(text, fallbacks=True):
+    """Locate Manim code in a response in linear time
+    
+    Strategies, in order: the <CODE_START>/<CODE_END> block, a ```python
+    fence, any ``` fence containing an import or class, bare code starting at
+    "from manim import", and bare code starting at a Scene subclass that has
+    a construct method.
+    
+    Args:
+        text: The response text to search
+        fallbacks: Whether to try the strategies after the tagged block
+    
+    Returns:
+        (code, strategy) where strategy names the strategy that matched, or
+        (None, None) if none did
+    """
+    if not text:
+        return None, None
+    
+    # The tagged block takes precedence; two str.find calls locate it fastest
+    code_start = text.find("<CODE_START>")
+    if code_start != -1:
+        code_end = text.find("<CODE_END>", code_start)
+        if code_end != -1:
+            return text[code_start + len("<CODE_START>"):code_end].strip(), "tagged"
+    if not fallbacks:
+        return None, None
+    
+    manim_import = scene = scene_import = None
+    fences = []
+    construct_after_scene = False
+    last_import = -1
+    # (position, marker) of every end marker, for bare code
+    marker_positions = []
+    
+    for match in _CODE_ANCHORS.finditer(text):
+        kind = match.lastgroup
+        if kind == "fence":
+            fences.append(match.start())
+        elif kind == "manim_import":
+            if manim_import is None:
+                manim_import = match.start()
+            last_import = match.start()
+        elif kind == "import":
+            last_import = match.start()
+        elif kind == "scene":
+            if scene is None:
+                scene = match.start()
+                scene_import = last_import
+        elif kind == "construct":
+            if scene is not None:
+                construct_after_scene = True
+        elif kind == "marker":
+            marker_positions.append((match.start(), match.group("marker")))
+    
+    # Markdown fences: the first ```python block, else the first block of any kind
+    for index, fence in enumerate(fences[:-1]):
+        if text.startswith("python", fence + 3):
+            return text[fence + len("```python"):fences[index + 1]].strip(), "fenced_python"
+    if len(fences) >= 2:
+        code = text[fences[0] + 3:fences[1]].strip()
+        if "import" in code or "class" in code:
+            return code, "fenced"
+    
+    # Bare code from the first manim import to the nearest end marker
+    if manim_import is not None:
+        end = next((position for position, _ in marker_positions if position >= manim_import), len(text))
+        return text[manim_import:end].strip(), "manim_import"
+    
+    # Bare code from the import above the first Scene subclass
+    if scene is not None and construct_after_scene:
+        start = scene
+        if scene_import != -1:
+            start = text.rfind("\n", 0, scene_import) + 1
+        end = len(text)
+        for marker in _CODE_END_MARKERS:
+            position = next((p for p, name in marker_positions if name == marker and p >= start), None)
+            if position is not None:
+                end = position
+                break
+        return text[start:end].strip(), "scene_class"
+    
+    return None, None
+
 def extract_code_only(text, topic=None):
     """Extract code from between <CODE_START> and <CODE_END> tags with topic validation.
     
@@ -241,14 +510,13 @@ def extract_code_only(text, topic=None):
     if not text:
         print("Error: Empty response received")
         return None
-        
-    # Try standard pattern first - this is the primary method that should be used
-    pattern = r'<CODE_START>(.*?)<CODE_END>'
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        code = match.group(1).strip()
+    
+    # Fallback strategies are only used when topic validation is not required
+    code, strategy = find_code(text, fallbacks=not topic)
+    
+    if strategy == "tagged":
         # If topic is provided, validate the code is about the topic
-        if topic and not validate_topic_relevance(code, topic):
+        if topic and not validate_topic_relevance(code, topic)["relevant"]:
             print(f"Warning: Extracted code does not appear to be about '{topic}'")
             return None
         return code
@@ -256,61 +524,151 @@ def extract_code_only(text, topic=None):
     # If standard pattern doesn't match, we have a formatting problem
     print("Warning: <CODE_START> and <CODE_END> tags not found in response")
     
-    # If topic validation is required, don't use fallback methods for safety
     if topic:
         print("ERROR: Strict topic validation required but <CODE_START> tags not found")
         print("Skipping fallback extraction methods for topic safety")
         return None
     
-    # Only use fallback methods when topic validation is not required
-    # Look for code blocks in markdown format
-    pattern = r'```python\s*(.*?)\s*```'
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
+    if strategy is None:
+        print("Warning: Could not extract code using any method")
+        return None
+    print(f"Extracted code using fallback strategy: {strategy}")
+    return code
+
+# Topics generated code has drifted to in the past. Finding one of these in
+# code without any reference to the requested topic is reported as the reason
+_PROBLEM_TOPICS = ("kinematic equation", "binary search", "binary tree")
+
+# How much one keyword found in each part of the code counts towards the
+# relevance score. A single hit in anything but an identifier is enough
+_RELEVANCE_WEIGHTS = {
+    "class_name": 1.0,
+    "docstring": 0.75,
+    "comment": 0.5,
+    "string": 0.5,
+    "identifier": 0.25,
+}
+RELEVANCE_THRESHOLD = 0.5
+
+_STRING_TOKENS = {tokenize.STRING} | {getattr(tokenize, "FSTRING_MIDDLE", tokenize.STRING)}
+
+@functools.lru_cache(maxsize=64)
+def _topic_matcher(topic):
+    """Compile one case-insensitive regex for every keyword of a topic
     
-    # Try any code block
-    pattern = r'```\s*(.*?)\s*```'
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        code = match.group(1).strip()
-        if "import" in code or "class" in code:
-            return code
-    
-    # Last resort fallbacks - these should rarely be needed with improved prompts
-    if "from manim import" in text:
-        start_idx = text.find("from manim import")
-        end_markers = ["\n\n<code_self_evaluation>", "\n\n---", "\n\nThis code"]
-        end_idx = len(text)
-        for marker in end_markers:
-            marker_pos = text.find(marker, start_idx)
-            if marker_pos != -1 and marker_pos < end_idx:
-                end_idx = marker_pos
-        return text[start_idx:end_idx].strip()
-    
-    # Look for a class definition with Scene
-    pattern = r'class\s+\w+\s*\(\s*Scene\s*\).*?def\s+construct\s*\(\s*self\s*\)'
-    match = re.search(pattern, text, re.DOTALL)
-    if match:
-        start_idx = match.start()
-        import_idx = text.rfind("import", 0, start_idx)
-        if import_idx != -1:
-            line_start = text.rfind("\n", 0, import_idx)
-            if line_start != -1:
-                start_idx = line_start + 1
-            else:
-                start_idx = 0
-        end_idx = len(text)
-        end_markers = ["\n\n<code_self_evaluation>", "\n\n---", "\n\nThis code"]
-        for marker in end_markers:
-            marker_pos = text.find(marker, start_idx)
-            if marker_pos != -1:
-                end_idx = marker_pos
-                break
-        return text[start_idx:end_idx].strip()
+    Returns:
+        (pattern, canonical) where canonical maps each lowercased spelling
+        the pattern can match to the keyword or problem topic it stands for
+    """
+    topic = topic.lower()
+    keywords = [word for word in topic.split() if len(word) > 3] or [topic]
+    if ' ' in topic:
+        keywords.append(topic)
     
-    print("Warning: Could not extract code using any method")
-    return None
+    canonical = {}
+    for keyword in keywords:
+        # Multi-word keywords also appear as LinearAlgebra or linear_algebra
+        for spelling in (keyword, keyword.replace(' ', ''), keyword.replace(' ', '_')):
+            canonical.setdefault(spelling, keyword)
+    for problem in _PROBLEM_TOPICS:
+        # Skip if the problem topic is actually the requested topic
+        if not any(keyword in problem for keyword in keywords):
+            canonical.setdefault(problem, "off_topic:" + problem)
+    
+    # Longest first, so a phrase wins over the words in it
+    alternatives = sorted(canonical, key=len, reverse=True)
+    pattern = re.compile('|'.join(re.escape(spelling) for spelling in alternatives), re.IGNORECASE)
+    return pattern, canonical
+
+def _code_text_parts(code):
+    """Yield (source, line, text) for the parts of code that say what it is about
+    
+    Comments come from tokenize, everything else from the AST. Code that does
+    not parse yet, such as a partially streamed response, falls back to the
+    tokens read before the first error.
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        tree = None
+    
+    previous = None
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type == tokenize.COMMENT:
+                yield "comment", token.start[0], token.string.lstrip('#')
+            elif tree is None and token.type in _STRING_TOKENS:
+                yield "string", token.start[0], token.string
+            elif tree is None and token.type == tokenize.NAME:
+                if previous == "class":
+                    yield "class_name", token.start[0], token.string
+                else:
+                    yield "identifier", token.start[0], token.string
+            if token.type == tokenize.NAME:
+                previous = token.string
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    
+    if tree is None:
+        return
+    
+    docstrings = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            body = node.body
+            if (body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant)
+                    and isinstance(body[0].value.value, str)):
+                docstrings.add(id(body[0].value))
+                yield "docstring", body[0].lineno, body[0].value.value
+        if isinstance(node, ast.ClassDef):
+            yield "class_name", node.lineno, node.name
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            yield "identifier", node.lineno, node.name
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            yield "identifier", node.lineno, node.id
+        elif (isinstance(node, ast.Constant) and isinstance(node.value, str)
+                and id(node) not in docstrings):
+            yield "string", node.lineno, node.value
+
+def score_topic_relevance(code, topic):
+    """Score how clearly code is about the requested topic
+    
+    Class names, docstrings, comments, string constants (titles, labels) and
+    assigned names are searched for the topic keywords with one precompiled
+    pattern. Works on partial code, so it can be run while a response streams.
+    
+    Args:
+        code: The extracted code, complete or not
+        topic: The topic to validate against
+    
+    Returns:
+        A dict with "score" (0.0 to 1.0), "relevant" (score reaches
+        RELEVANCE_THRESHOLD), "evidence" (one dict per keyword and source
+        with the line it was first seen on) and "off_topic" (known unrelated
+        topics the code mentions)
+    """
+    result = {"score": 0.0, "relevant": False, "evidence": [], "off_topic": []}
+    if not code or not topic:
+        return result
+    
+    pattern, canonical = _topic_matcher(topic)
+    seen = set()
+    for source, line, text in _code_text_parts(code):
+        for match in pattern.finditer(text):
+            keyword = canonical[match.group(0).lower()]
+            if keyword.startswith("off_topic:"):
+                if keyword[len("off_topic:"):] not in result["off_topic"]:
+                    result["off_topic"].append(keyword[len("off_topic:"):])
+                continue
+            if (source, keyword) in seen:
+                continue
+            seen.add((source, keyword))
+            result["evidence"].append({"source": source, "keyword": keyword, "line": line})
+            result["score"] += _RELEVANCE_WEIGHTS[source]
+    
+    result["score"] = min(1.0, result["score"])
+    result["relevant"] = result["score"] >= RELEVANCE_THRESHOLD
+    return result
 
 def validate_topic_relevance(code, topic):
     """Check if code is relevant to the requested topic.
@@ -318,67 +676,27 @@ def validate_topic_relevance(code, topic):
     Args:
         code: The extracted code
         topic: The topic to validate against
-        
+    
     Returns:
-        True if the code is relevant to the topic, False otherwise
+        The score_topic_relevance result; its "relevant" entry is True if the
+        code is relevant to the topic
     """
-    if not code or not topic:
-        return False
-    
-    # Get meaningful keywords from the topic
-    topic_keywords = [word.lower() for word in topic.lower().split() if len(word) > 3]
-    if not topic_keywords:
-        topic_keywords = [topic.lower()]
-    
-    # Add full phrase for multi-word topics
-    if ' ' in topic.lower():
-        topic_keywords.append(topic.lower())
-    
-    # Check class name
-    class_match = re.search(r'class\s+(\w+)', code)
-    class_name = class_match.group(1).lower() if class_match else ""
-    
-    # Check for topic in class name
-    class_relevance = any(keyword in class_name for keyword in topic_keywords)
-    if class_relevance:
-        return True
-    
-    # Check comments
-    comment_lines = [line.split('#')[1].strip() if '#' in line and line.strip()[0] != '#' else "" 
-                    for line in code.split('\n') if '#' in line]
-    comments_text = ' '.join(comment_lines).lower()
-    
-    # Check for topic in comments
-    comment_relevance = any(keyword in comments_text for keyword in topic_keywords)
-    if comment_relevance:
-        return True
-    
-    # Check string literals for topic references
-    string_literals = re.findall(r'"([^"]*)"', code) + re.findall(r"'([^']*)'", code)
-    strings_text = ' '.join(string_literals).lower()
-    
-    # Check for topic in string literals (titles, labels, etc.)
-    string_relevance = any(keyword in strings_text for keyword in topic_keywords)
-    if string_relevance:
-        return True
-    
-    # Check for unrelated topics (known problematic topics)
-    problem_topics = ["kinematic equation", "binary search", "binary tree"]
-    for problem in problem_topics:
-        # Skip if the problem topic is actually the requested topic
-        if any(keyword in problem for keyword in topic_keywords):
-            continue
-            
-        # Check if code is about a different topic
-        if (problem in comments_text or problem in strings_text or problem in class_name):
-            print(f"Warning: Code appears to be about '{problem}' instead of '{topic}'")
-            return False
+    relevance = score_topic_relevance(code, topic)
+    if relevance["relevant"]:
+        evidence = ", ".join(f"{item['keyword']!r} in {item['source']} (line {item['line']})"
+                             for item in relevance["evidence"][:3])
+        print(f"Topic relevance {relevance['score']:.2f}: {evidence}")
+        return relevance
     
-    # If none of the checks passed, the code might not be relevant
-    print(f"Warning: Code doesn't contain references to '{topic}'")
-    print(f"Class name: {class_name}")
-    print(f"First 100 chars of code: {code[:100]}...")
-    return False
+    if relevance["off_topic"]:
+        print(f"Warning: Code appears to be about '{relevance['off_topic'][0]}' instead of '{topic}'")
+    else:
+        # If none of the checks passed, the code might not be relevant
+        print(f"Warning: Code doesn't contain enough references to '{topic}' "
+              f"(relevance {relevance['score']:.2f})")
+    if code:
+        print(f"First 100 chars of code: {code[:100]}...")
+    return relevance
 
 def extract_section(text, section_name):
     """Extract content from a specific XML-like section
@@ -399,6 +717,82 @@ def extract_section(text, section_name):
         return match.group(1).strip()
     return None
 
+# Any <tag> or </tag>; parse_sections pairs them up in a single scan
+_SECTION_TAG = re.compile(r'<(/?)([A-Za-z_][A-Za-z0-9_]*)>')
+
+# The code block uses its own marker pair and is returned under this key
+CODE_SECTION = "code"
+
+def parse_sections(text, include_unterminated=False):
+    """Split a response into all of its tagged sections in one pass
+    
+    Gives the same result as calling extract_section for every tag: each
+    section is the text between the first <name> and the first </name> after
+    it, stripped. Sections nested inside another are returned on their own
+    as well, and the outer section keeps them in its text. The
+    <CODE_START>...<CODE_END> block is returned under "code".
+    
+    Args:
+        text: The response text to parse
+        include_unterminated: Also return sections whose closing tag is missing,
+            e.g. in a truncated response, running to the end of the text
+    
+    Returns:
+        A dict mapping section names to their content
+    """
+    sections = {}
+    if not text:
+        return sections
+    
+    # Start offset of the content of each section opened but not yet closed
+    open_sections = {}
+    for match in _SECTION_TAG.finditer(text):
+        closing, name = match.group(1), match.group(2)
+        if name == "CODE_START":
+            name = CODE_SECTION
+        elif name == "CODE_END":
+            closing, name = "/", CODE_SECTION
+        
+        if name in sections:
+            continue
+        if not closing:
+            open_sections.setdefault(name, match.end())
+        elif name in open_sections:
+            sections[name] = text[open_sections.pop(name):match.start()].strip()
+    
+    if include_unterminated:
+        for name, start in open_sections.items():
+            sections[name] = text[start:].strip()
+    return sections
+
+def apply_patches(code, text):
+    """Apply the search/replace patches in a render fix response to code
+    
+    Args:
+        code: The code the patches were written against
+        text: The response text containing <PATCH> blocks
+    
+    Returns:
+        The patched code, or None if there are no patches or any search block
+        does not match the code exactly once
+    """
+    if not code or not text:
+        return None
+    
+    pattern = r'<SEARCH>\n?(.*?)\n?</SEARCH>\s*<REPLACE>\n?(.*?)\n?</REPLACE>'
+    patches = re.findall(pattern, text, re.DOTALL)
+    if not patches:
+        print("Warning: No <PATCH> blocks found in render fix response")
+        return None
+    
+    for search, replace in patches:
+        count = code.count(search) if search else 0
+        if count != 1:
+            print(f"Warning: Patch search block matches the code {count} times, expected once")
+            return None
+        code = code.replace(search, replace)
+    return code
+
 def create_topic_safe_classname(topic):
     """Create a safe class name from a topic
     
@@ -434,4 +828,29 @@ def format_code_generation_prompt(topic, design_scene):
         safe_class_name=safe_class_name
     )
     
-    return formatted_prompt
\ No newline at end of file
+    return formatted_prompt
+
+class SectionWatcher:
+    """Incrementally watch a streamed response for closing markers.
+    
+    Feed text chunks as they arrive; feed() returns True once every marker has
+    been seen, so the caller can stop the stream without waiting for the rest
+    of the completion. Markers split across chunk boundaries are still found.
+    """
+    
+    def __init__(self, markers):
+        self.pending = set(markers or [])
+        self._tail = ""
+        self._overlap = max((len(marker) for marker in self.pending), default=1) - 1
+    
+    def feed(self, chunk):
+        """Consume a chunk of text and return True when all markers have closed"""
+        if not self.pending:
+            return False
+        window = self._tail + chunk
+        for marker in list(self.pending):
+            if marker in window:
+                self.pending.discard(marker)
+        # Keep just enough text to catch a marker straddling the next chunk
+        self._tail = window[-self._overlap:] if self._overlap else ""
+        return not self.pending
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: the bucket is still shared between threads, not processes
+    fcntl = None
+
+# HTTP statuses worth retrying: rate limited, service unavailable, overloaded
+RETRYABLE_STATUS_CODES = (429, 503, 529)
+
+
+def estimate_tokens(*texts):
+    """Rough input token estimate (~4 characters per token)"""
+    return sum(len(text) for text in texts if text) // 4 + 1
+
+
+def is_retryable(error):
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def retry_after_seconds(error):
+    """Read the retry-after header from an API error, if the server sent one"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimiter:
+    """Requests/minute and tokens/minute token buckets shared through a local file.
+
+    Every main.py process on the machine that points at the same state file
+    draws from the same buckets, so parallel runs stay inside one quota. When
+    the API answers 429, the back-off is written to the file as well and all
+    processes pause until it expires.
+    """
+
+    def __init__(self, state_file, requests_per_minute=50, tokens_per_minute=40000,
+                 max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.state_file = state_file
+        self.lock_file = state_file + ".lock"
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._thread_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+
+    def _locked(self, update):
+        """Run update(state) under the cross-process lock and persist the new state"""
+        with self._thread_lock:
+            with open(self.lock_file, 'a') as lock:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    state = self._load()
+                    result = update(state, time.time())
+                    tmp_path = f"{self.state_file}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'w') as f:
+                        json.dump(state, f)
+                    os.replace(tmp_path, self.state_file)
+                    return result
+                finally:
+                    if fcntl:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state.get("updated", now))
+        state["updated"] = now
+        for bucket, per_minute in (("requests", self.requests_per_minute), ("tokens", self.tokens_per_minute)):
+            if per_minute:
+                level = state.get(bucket, per_minute)
+                state[bucket] = min(per_minute, level + elapsed * per_minute / 60.0)
+
+    def _try_take(self, tokens):
+        """Take one request and `tokens` tokens; returns seconds to wait (0 if granted)"""
+        def update(state, now):
+            self._refill(state, now)
+            blocked_for = state.get("blocked_until", 0) - now
+            if blocked_for > 0:
+                return blocked_for
+
+            wait = 0.0
+            if self.requests_per_minute and state["requests"] < 1:
+                wait = max(wait, (1 - state["requests"]) * 60.0 / self.requests_per_minute)
+            # A request larger than the whole bucket only waits for a full bucket
+            needed = min(tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+            if self.tokens_per_minute and state["tokens"] < needed:
+                wait = max(wait, (needed - state["tokens"]) * 60.0 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+
+            if self.requests_per_minute:
+                state["requests"] -= 1
+            if self.tokens_per_minute:
+                state["tokens"] -= needed
+            return 0.0
+        return self._locked(update)
+
+    def acquire(self, tokens):
+        """Block until a request of roughly `tokens` input tokens may be sent"""
+        while True:
+            wait = self._try_take(tokens)
+            if wait <= 0:
+                return
+            print(f"Rate limiter: waiting {wait:.1f}s for quota")
+            time.sleep(min(wait, 5.0))
+
+    async def acquire_async(self, tokens):
+        """Async counterpart of acquire"""
+        while True:
+            wait = await asyncio.to_thread(self._try_take, tokens)
+            if wait <= 0:
+                return
+            print(f"Rate limiter: waiting {wait:.1f}s for quota")
+            await asyncio.sleep(min(wait, 5.0))
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real input token count is known"""
+        if not self.tokens_per_minute or not actual_tokens:
+            return
+        def update(state, now):
+            self._refill(state, now)
+            state["tokens"] -= actual_tokens - min(estimated_tokens, self.tokens_per_minute)
+        self._locked(update)
+
+    def backoff(self, attempt, error):
+        """Return how long to wait before retrying after a retryable error.
+
+        Honours retry-after when present, otherwise uses exponential backoff with
+        full jitter. The pause is shared so other processes back off too.
+        """
+        delay = retry_after_seconds(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        else:
+            delay += random.uniform(0, self.base_delay)
+
+        def update(state, now):
+            self._refill(state, now)
+            state["blocked_until"] = max(state.get("blocked_until", 0), now + delay)
+        self._locked(update)
+
+        print(f"API returned {getattr(error, 'status_code', '?')} - retrying in {delay:.1f}s "
+              f"(attempt {attempt + 1}/{self.max_retries})")
+        return delay
@@ -0,0 +1,321 @@
+import asyncio
+import collections
+import concurrent.futures
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from partial_cache import PartialMovieCache
+from render_worker import QUALITY_FLAGS, RenderWorker, default_output_path
+
+
+def _core_groups(workers):
+    """Split the usable CPU cores into one group per worker"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if workers >= len(cores):
+        return [[cores[index % len(cores)]] for index in range(workers)]
+    return [cores[index * len(cores) // workers:(index + 1) * len(cores) // workers]
+            for index in range(workers)]
+
+
+class RenderPool:
+    """Runs Manim renders in parallel on a fixed number of render workers.
+
+    Jobs are queued per owner (normally the topic) and handed out round-robin
+    across owners, so a topic with many renders queued cannot hold back the
+    others. Background jobs, such as final-quality re-renders, only run when
+    no other job is waiting. Each worker is pinned to its own group of cores and is only
+    started once there is a job for it. Memory and CPU time limits are applied
+    per worker and per job as described in RenderWorker, and all workers
+    share the same partial movie cache.
+    """
+
+    def __init__(self, workers=None, warm=True, timeout=600, memory_mb=None, cpu_seconds=None, cache=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.warm = warm
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.cache = cache
+        self._queues = collections.OrderedDict()
+        self._background = collections.OrderedDict()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._idle = 0
+        self._closed = False
+        self._cores = _core_groups(self.workers)
+
+    def _queue(self, call, owner, background):
+        """Queue call(worker) to run on the next free worker; returns a Future for its result"""
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("RenderPool is closed")
+            queues = self._background if background else self._queues
+            queues.setdefault(owner, collections.deque()).append((future, call))
+            # Wake an idle worker, or start another one while below the limit
+            if self._idle:
+                self._idle -= 1
+                self._condition.notify()
+            elif len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, args=(len(self._threads),),
+                                          name=f"render-pool-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+        return future
+
+    def submit(self, filepath, class_name, media_dir, quality="low_quality", owner=None, background=False,
+               animations=None, output_path=None):
+        """Queue a render; returns a Future for its (video_path, error) result"""
+        return self._queue(
+            lambda worker: worker.render(filepath, class_name, media_dir, quality, animations, output_path),
+            owner, background
+        )
+
+    def render(self, filepath, class_name, media_dir, quality="low_quality", owner=None, output_path=None):
+        """Render and wait; returns (video_path, error) as RenderWorker.render does"""
+        return self.submit(filepath, class_name, media_dir, quality, owner, output_path=output_path).result()
+
+    def submit_dry_run(self, filepath, class_name, owner=None, background=False, media_dir=None):
+        """Queue a dry run; returns a Future for RenderWorker.dry_run's result"""
+        return self._queue(lambda worker: worker.dry_run(filepath, class_name, media_dir), owner, background)
+
+    def dry_run(self, filepath, class_name, owner=None, background=False, media_dir=None):
+        """Dry-run a scene on the next free worker and wait; returns RenderWorker.dry_run's result"""
+        return self.submit_dry_run(filepath, class_name, owner, background, media_dir).result()
+
+    def render_segmented(self, filepath, class_name, media_dir, quality="low_quality", owner=None,
+                         background=False, num_plays=None, output_path=None):
+        """Render one scene as several ranges of play() calls in parallel and join them.
+
+        A dry run in a warm worker counts the play() calls, unless the count is
+        passed as num_plays. The scene is then
+        split into up to self.workers contiguous ranges of at least two calls;
+        each range is rendered by its own worker, which fast-forwards through
+        the calls before it, into a media directory of its own. The segment
+        videos are joined with ffmpeg's concat demuxer without re-encoding,
+        into output_path, or the file a normal render would have written.
+
+        Falls back to a normal render when the scene cannot be counted, is too
+        short to split, or the segments cannot be joined. Must not be called
+        from a pool worker. Returns (video_path, error) like render().
+        """
+        count = num_plays
+        if count is None:
+            check = self.dry_run(filepath, class_name, owner, background)
+            count = check["num_plays"] if check and not check["error"] else None
+        segments = min(self.workers, (count or 0) // 2)
+        if segments < 2:
+            return self.submit(filepath, class_name, media_dir, quality, owner, background,
+                               output_path=output_path).result()
+
+        stem = os.path.splitext(os.path.basename(filepath))[0]
+        bounds = [index * count // segments for index in range(segments + 1)]
+        futures = []
+        for index in range(segments):
+            # The last range is open-ended so nothing after the counted calls is lost
+            last = bounds[index + 1] - 1 if index < segments - 1 else None
+            futures.append(self.submit(
+                filepath, class_name, os.path.join(media_dir, "segments", f"{stem}_{index}"),
+                quality, owner, background, animations=(bounds[index], last)
+            ))
+        print(f"Rendering {class_name} as {segments} segments of {count} play() calls in parallel")
+
+        segment_paths = []
+        for future in futures:
+            video_path, error = future.result()
+            if not video_path:
+                for pending in futures:
+                    pending.cancel()
+                return None, error
+            segment_paths.append(video_path)
+
+        output_path = output_path or default_output_path(filepath, class_name, media_dir, quality)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        if concat_videos(segment_paths, output_path):
+            return output_path, None
+        print(f"Could not join the segments of {class_name}; rendering it in one piece")
+        return self.submit(filepath, class_name, media_dir, quality, owner, background,
+                           output_path=output_path).result()
+
+    def submit_segmented(self, filepath, class_name, media_dir, quality="low_quality", owner=None,
+                         background=False, num_plays=None, output_path=None):
+        """render_segmented in a thread of its own; returns a Future for (video_path, error)"""
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(self.render_segmented(filepath, class_name, media_dir, quality, owner,
+                                                        background, num_plays, output_path))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name=f"segmented-{class_name}", daemon=True).start()
+        return future
+
+    async def render_async(self, filepath, class_name, media_dir, quality="low_quality", owner=None,
+                           output_path=None):
+        """Render without blocking the event loop; returns (video_path, error)"""
+        return await asyncio.wrap_future(self.submit(filepath, class_name, media_dir, quality, owner,
+                                                     output_path=output_path))
+
+    def _next_job(self):
+        """Take the next job, rotating through owners; call with the condition held"""
+        while not self._closed:
+            queues = self._queues or self._background
+            if not queues:
+                # submit() takes this worker off the idle count when it wakes it
+                self._idle += 1
+                self._condition.wait()
+                continue
+            owner, queue = next(iter(queues.items()))
+            del queues[owner]
+            job = queue.popleft()
+            if queue:
+                # This owner goes to the back of the rotation
+                queues[owner] = queue
+            if job[0].set_running_or_notify_cancel():
+                return job
+        return None
+
+    def _run(self, index):
+        worker = RenderWorker(timeout=self.timeout, warm=self.warm, cpus=self._cores[index],
+                              memory_mb=self.memory_mb, cpu_seconds=self.cpu_seconds, cache=self.cache)
+        try:
+            while True:
+                with self._condition:
+                    job = self._next_job()
+                if job is None:
+                    return
+                future, call = job
+                try:
+                    future.set_result(call(worker))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            worker.close()
+
+    def close(self):
+        """Cancel queued jobs and stop the workers after their current render"""
+        with self._condition:
+            self._closed = True
+            for queues in (self._queues, self._background):
+                for queue in queues.values():
+                    for job in queue:
+                        job[0].cancel()
+                queues.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def concat_videos(paths, output_path):
+    """Join videos with identical encoding settings by stream copy; returns True on success"""
+    list_path = f"{output_path}.{os.getpid()}.txt"
+    tmp_path = f"{output_path}.{os.getpid()}.tmp{os.path.splitext(output_path)[1]}"
+    try:
+        with open(list_path, 'w') as f:
+            for path in paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        result = subprocess.run(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path,
+             '-c', 'copy', tmp_path],
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            print(f"ffmpeg concat failed: {result.stderr.strip()[-500:]}")
+            return False
+        os.replace(tmp_path, output_path)
+        return True
+    except OSError as e:
+        print(f"ffmpeg concat failed: {e}")
+        return False
+    finally:
+        for path in (list_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _scene_class(path):
+    """The first Scene subclass defined in a file, or None"""
+    with open(path, 'r') as f:
+        match = re.search(r'^class\s+(\w+)\s*\(\s*\w*Scene\s*\)', f.read(), re.MULTILINE)
+    return match.group(1) if match else None
+
+
+def main():
+    """Batch mode: render many scene files in parallel and report the results"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Render Manim scene files in parallel")
+    parser.add_argument("files", nargs="+", help="Scene files to render")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Parallel renders (default: one per CPU core)")
+    parser.add_argument("--quality", choices=sorted(QUALITY_FLAGS), default="low_quality",
+                        help="Render quality")
+    parser.add_argument("--media-dir", default=None,
+                        help="Media directory (default: media next to each file)")
+    parser.add_argument("--memory-mb", type=int, default=None,
+                        help="Address space limit per render worker in MB")
+    parser.add_argument("--cpu-seconds", type=int, default=None,
+                        help="CPU time limit per render in seconds")
+    parser.add_argument("--timeout", type=int, default=600,
+                        help="Wall clock limit per render in seconds")
+    parser.add_argument("--partial-cache", default=None,
+                        help="Directory of a partial movie cache to share between the renders")
+    parser.add_argument("--partial-cache-mb", type=int, default=2048,
+                        help="Size limit of the partial movie cache in MB")
+    parser.add_argument("--segmented", action="store_true",
+                        help="Split each scene into ranges of play() calls rendered on several workers")
+    parser.add_argument("--cold", action="store_true",
+                        help="Start a new manim process for every render instead of warm workers")
+    args = parser.parse_args()
+
+    cache = None
+    if args.partial_cache:
+        cache = PartialMovieCache(os.path.abspath(args.partial_cache), max_bytes=args.partial_cache_mb * 1024 ** 2)
+    pool = RenderPool(workers=args.workers, warm=not args.cold, timeout=args.timeout,
+                      memory_mb=args.memory_mb, cpu_seconds=args.cpu_seconds, cache=cache)
+    started = time.monotonic()
+    jobs = []
+    for path in args.files:
+        path = os.path.abspath(path)
+        class_name = _scene_class(path)
+        if not class_name:
+            print(f"{path}: no Scene subclass found, skipped")
+            continue
+        media_dir = os.path.abspath(args.media_dir) if args.media_dir else os.path.join(os.path.dirname(path), "media")
+        # Each file is its own owner so the files share the workers evenly
+        submit = pool.submit_segmented if args.segmented else pool.submit
+        jobs.append((path, submit(path, class_name, media_dir, args.quality, owner=path)))
+
+    failures = 0
+    try:
+        for path, future in jobs:
+            video_path, error = future.result()
+            if video_path:
+                print(f"OK    {path} -> {video_path}")
+            else:
+                failures += 1
+                last_line = error.strip().splitlines()[-1] if error else "crashed or timed out"
+                print(f"FAIL  {path}: {last_line}")
+    finally:
+        pool.close()
+
+    print(f"\nRendered {len(jobs) - failures}/{len(jobs)} scenes with {pool.workers} workers "
+          f"in {time.monotonic() - started:.1f}s")
+    return 1 if failures or len(jobs) < len(args.files) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,455 @@
+import glob
+import importlib.util
+import itertools
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+
+from partial_cache import read_partial_movie_list
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; limits are then not enforced
+    resource = None
+
+# Seconds to wait for the worker to import Manim
+STARTUP_TIMEOUT = 120
+
+# Seconds a dry run may take; construct() without rendering is fast unless it never ends
+DRY_RUN_TIMEOUT = 30
+
+# Config for a dry run: every play() call is fast-forwarded as if it came before
+# the first animation to render, and nothing is written
+DRY_RUN_CONFIG = {"dry_run": True, "from_animation_number": 10 ** 9}
+
+# manim command line flags for the same dry run
+DRY_RUN_FLAGS = ['--dry_run', '-n', str(DRY_RUN_CONFIG["from_animation_number"])]
+
+# manim command line flag for each config quality
+QUALITY_FLAGS = {
+    "low_quality": "-ql",
+    "medium_quality": "-qm",
+    "high_quality": "-qh",
+    "production_quality": "-qp",
+    "fourk_quality": "-qk",
+}
+
+# Directory Manim names after the resolution and frame rate of each quality
+QUALITY_DIRS = {
+    "low_quality": "480p15",
+    "medium_quality": "720p30",
+    "high_quality": "1080p60",
+    "production_quality": "1440p60",
+    "fourk_quality": "2160p60",
+}
+
+
+class CPULimitExceeded(Exception):
+    """Raised inside a render when it uses up its CPU time limit"""
+
+
+def _on_cpu_limit(signum, frame):
+    raise CPULimitExceeded("render exceeded its CPU time limit")
+
+
+def apply_limits(cpus=None, memory_mb=None):
+    """Pin the current process to cpus and cap its address space at memory_mb"""
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    if memory_mb and resource is not None:
+        limit = int(memory_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _set_cpu_limit(cpu_seconds):
+    """Allow the current process cpu_seconds more CPU time, or unlimited for None"""
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if cpu_seconds is None:
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime + cpu_seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+# Partial movie cache lookups of the job the worker is rendering
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def _install_partial_cache(cache):
+    """Make Manim look in the shared partial movie cache before rendering a play() call"""
+    from manim import config
+    from manim.scene.scene_file_writer import SceneFileWriter
+
+    is_already_cached = SceneFileWriter.is_already_cached
+
+    def is_already_cached_or_shared(self, hash_invocation):
+        if is_already_cached(self, hash_invocation):
+            _cache_stats["hits"] += 1
+            return True
+        name = f"{hash_invocation}{config['movie_file_extension']}"
+        partial_movie_dir = self.partial_movie_directory
+        resolution = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(partial_movie_dir))))
+        if cache.fetch(resolution, name, os.path.join(partial_movie_dir, name)):
+            _cache_stats["hits"] += 1
+            return True
+        _cache_stats["misses"] += 1
+        return False
+
+    SceneFileWriter.is_already_cached = is_already_cached_or_shared
+
+
+def _record_play_durations(renderer):
+    """Collect the run time of every play() and wait() call the renderer makes.
+
+    The renderer's own clock only advances for frames it draws, so it stays
+    at 0 when every animation is skipped; the scene's duration is set for
+    each call either way.
+    """
+    durations = []
+    play = renderer.play
+
+    def play_and_record(scene, *args, **kwargs):
+        play(scene, *args, **kwargs)
+        durations.append(getattr(scene, "duration", 0) or 0)
+
+    renderer.play = play_and_record
+    return durations
+
+
+def _render_job(manim, job, cache=None):
+    """Render one scene file inside the worker; returns the reply dict"""
+    module_name = f"_render_job_{job['id']}"
+    _cache_stats.update(hits=0, misses=0)
+    try:
+        _set_cpu_limit(job.get("cpu_seconds"))
+        spec = importlib.util.spec_from_file_location(module_name, job["filepath"])
+        module = importlib.util.module_from_spec(spec)
+        # tempconfig restores Manim's global config afterwards, so one job's
+        # quality and directories never leak into the next
+        with manim.tempconfig(dict(job["config"], input_file=job["filepath"])):
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+            scene = getattr(module, job["class_name"])()
+            if job["config"].get("dry_run"):
+                durations = _record_play_durations(scene.renderer)
+                scene.render()
+                return {"video_path": None, "error": None, "num_plays": scene.renderer.num_plays,
+                        "duration": sum(durations)}
+            scene.render()
+            if cache is not None:
+                cache.add_directory(scene.renderer.file_writer.partial_movie_directory)
+                cache.evict()
+            return {"video_path": str(scene.renderer.file_writer.movie_file_path), "error": None,
+                    "cache": dict(_cache_stats)}
+    except Exception:
+        return {"video_path": None, "error": traceback.format_exc()}
+    finally:
+        _set_cpu_limit(None)
+        sys.modules.pop(module_name, None)
+
+
+def _serve(connection, cpus=None, memory_mb=None, cache=None):
+    """Worker process main loop: import Manim once, then render jobs until told to stop"""
+    try:
+        apply_limits(cpus, memory_mb)
+        if resource is not None:
+            signal.signal(signal.SIGXCPU, _on_cpu_limit)
+        import manim
+        if cache is not None:
+            _install_partial_cache(cache)
+    except Exception as e:
+        connection.send({"ready": False, "error": repr(e)})
+        return
+    connection.send({"ready": True, "manim_version": manim.__version__})
+
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        connection.send(_render_job(manim, job, cache))
+
+
+def scene_video_dir(filepath, media_dir, quality="low_quality"):
+    """Manim's directory for a scene file's renders: <media_dir>/videos/<file>/<resolution>"""
+    stem = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.join(media_dir, "videos", stem, QUALITY_DIRS.get(quality, "480p15"))
+
+
+def default_output_path(filepath, class_name, media_dir, quality="low_quality"):
+    """The video a render writes when it is given no output path, where Manim puts it by default"""
+    return os.path.join(scene_video_dir(filepath, media_dir, quality), f"{class_name}.mp4")
+
+
+def _report_cache(class_name, stats):
+    if stats and stats["hits"] + stats["misses"]:
+        print(f"Partial movie cache for {class_name}: {stats['hits']} hits, {stats['misses']} misses")
+
+
+def _run_manim(arguments, filepath, timeout=None, cpus=None, memory_mb=None, cpu_seconds=None):
+    """Run the manim command next to filepath under the same limits as a worker.
+
+    Returns the completed process; raises subprocess.TimeoutExpired or OSError
+    as subprocess.run does.
+    """
+    def limit_child():
+        apply_limits(cpus, memory_mb)
+        if cpu_seconds and resource is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (int(cpu_seconds), resource.RLIM_INFINITY))
+
+    return subprocess.run(
+        ['manim'] + arguments,
+        cwd=os.path.dirname(os.path.abspath(filepath)),
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+        preexec_fn=limit_child if os.name == "posix" else None
+    )
+
+
+def render_with_command(filepath, class_name, media_dir, quality="low_quality", timeout=None,
+                        cpus=None, memory_mb=None, cpu_seconds=None, cache=None, animations=None,
+                        output_path=None):
+    """Render with a new manim process, under the same limits as a worker.
+
+    The manim command cannot look in the shared partial movie cache, but the
+    partial movie files it renders are added to it.
+
+    Returns (video_path, None) on success, (None, stderr) when Manim fails, or
+    (None, None) when the process could not run or timed out.
+    """
+    output_path = output_path or default_output_path(filepath, class_name, media_dir, quality)
+    # Partial movie files of earlier renders of this scene at this quality
+    partial_movie_dir = os.path.join(scene_video_dir(filepath, media_dir, quality), "partial_movie_files",
+                                     class_name)
+    existing = {os.path.basename(path) for path in glob.glob(os.path.join(glob.escape(partial_movie_dir), "*"))}
+
+    # Manim joins the output file onto its video directory, so an absolute path is used as is
+    arguments = [QUALITY_FLAGS.get(quality, "-ql"), '--media_dir', media_dir, '-o', os.path.abspath(output_path)]
+    if animations:
+        arguments += ['-n', ",".join(str(number) for number in animations if number is not None)]
+
+    try:
+        result = _run_manim(arguments + [filepath, class_name], filepath, timeout, cpus, memory_mb, cpu_seconds)
+    except subprocess.TimeoutExpired:
+        print(f"Render of {class_name} timed out after {timeout}s")
+        return None, None
+    except OSError as e:
+        print(f"Error running Manim: {e}")
+        return None, None
+
+    if result.returncode != 0:
+        return None, result.stderr or result.stdout
+    if not os.path.exists(output_path):
+        print(f"manim finished without writing {output_path}")
+        return None, None
+    if cache is not None:
+        # Files listed for this render that were there before it were reused
+        used = read_partial_movie_list(partial_movie_dir)
+        hits = sum(1 for name in used if name in existing)
+        _report_cache(class_name, {"hits": hits, "misses": len(used) - hits})
+        cache.add_directory(partial_movie_dir)
+        cache.evict()
+    return output_path, None
+
+
+def dry_run_with_command(filepath, class_name, media_dir=None, timeout=DRY_RUN_TIMEOUT, cpus=None,
+                         memory_mb=None, cpu_seconds=None):
+    """Dry-run a scene with manim --dry_run, under the same limits as a worker.
+
+    Returns a dict like RenderWorker.dry_run, or None when the manim command
+    could not run. The command does not report the number of play() calls
+    or the duration, so both are None.
+    """
+    arguments = ['-ql'] + DRY_RUN_FLAGS
+    if media_dir:
+        arguments += ['--media_dir', media_dir]
+    try:
+        result = _run_manim(arguments + [filepath, class_name], filepath, timeout, cpus, memory_mb, cpu_seconds)
+    except subprocess.TimeoutExpired:
+        return {"error": _dry_run_timeout_error(class_name), "num_plays": None, "duration": None}
+    except OSError as e:
+        print(f"Error running Manim: {e}")
+        return None
+    error = (result.stderr or result.stdout) if result.returncode != 0 else None
+    return {"error": error, "num_plays": None, "duration": None}
+
+
+def _dry_run_timeout_error(class_name):
+    return (f"construct() of {class_name} crashed or ran past {DRY_RUN_TIMEOUT}s without rendering; "
+            "check for endless loops")
+
+
+class RenderWorker:
+    """A Manim process that stays alive between renders.
+
+    Starting `manim` for every video pays for interpreter startup, the Manim
+    import and renderer initialization, which is a large share of a short -ql
+    render. The worker imports Manim once and renders scene files sent to it
+    over a pipe, each with its own config and media directory. It is started
+    on the first render and replaced after max_jobs renders, a timeout or a
+    crash. With warm=False, or if Manim cannot be imported in this
+    interpreter, every render runs the manim command instead.
+
+    The process is pinned to cpus and limited to memory_mb of address space;
+    each render may use cpu_seconds of CPU time. With a PartialMovieCache,
+    play() calls already rendered by any scene are reused from it.
+    """
+
+    def __init__(self, timeout=600, max_jobs=50, warm=True, cpus=None, memory_mb=None,
+                 cpu_seconds=None, cache=None):
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.warm = warm
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.cache = cache
+        self._process = None
+        self._connection = None
+        self._jobs = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        parent_end, child_end = context.Pipe()
+        # Manim runs LaTeX and ffmpeg through subprocess, which a daemon process may do
+        process = context.Process(target=_serve, args=(child_end, self.cpus, self.memory_mb, self.cache),
+                                  name="manim-render-worker", daemon=True)
+        process.start()
+        child_end.close()
+
+        if not parent_end.poll(STARTUP_TIMEOUT):
+            print("Render worker did not start in time; using the manim command instead")
+            process.kill()
+            self.warm = False
+            return False
+        try:
+            reply = parent_end.recv()
+        except EOFError:
+            reply = {"ready": False, "error": "worker exited during startup"}
+        if not reply.get("ready"):
+            print(f"Render worker unavailable ({reply.get('error')}); using the manim command instead")
+            process.join()
+            self.warm = False
+            return False
+
+        print(f"Render worker started (manim {reply['manim_version']}, pid {process.pid})")
+        self._process, self._connection, self._jobs = process, parent_end, 0
+        return True
+
+    def _stop(self):
+        if self._process is None:
+            return
+        try:
+            self._connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
+        self._connection.close()
+        self._process = self._connection = None
+
+    def _send(self, filepath, class_name, config, timeout=None):
+        """Run one job in the started worker; returns its reply, or None if it crashed or timed out"""
+        timeout = timeout or self.timeout
+        job = {
+            "id": next(self._ids),
+            "filepath": filepath,
+            "class_name": class_name,
+            "config": config,
+            "cpu_seconds": self.cpu_seconds,
+        }
+        try:
+            self._connection.send(job)
+            if not self._connection.poll(timeout):
+                print(f"Render of {class_name} timed out after {timeout}s; restarting the worker")
+                self._process.kill()
+                self._stop()
+                return None
+            reply = self._connection.recv()
+        except (EOFError, OSError):
+            print(f"Render worker died while rendering {class_name}; it will be restarted")
+            self._stop()
+            return None
+
+        self._jobs += 1
+        if self._jobs >= self.max_jobs:
+            # Scenes can leave state behind in the process, so start fresh periodically
+            self._stop()
+        return reply
+
+    def render(self, filepath, class_name, media_dir, quality="low_quality", animations=None,
+               output_path=None):
+        """Render class_name from filepath into media_dir.
+
+        The video is written to output_path, default_output_path() if not
+        given, so where it lands is known before the render starts; media_dir
+        holds everything else Manim writes.
+
+        animations is an optional (first, last) range of play() calls to render,
+        counted from 0 and inclusive; last may be None for the rest of the scene.
+        The play() calls before first are fast-forwarded without rendering.
+
+        Returns (video_path, None) on success, (None, error) when the scene
+        fails, or (None, None) when the render crashed or timed out.
+        """
+        with self._lock:
+            if self._process is None and not (self.warm and self._start()):
+                return render_with_command(filepath, class_name, media_dir, quality, self.timeout,
+                                           self.cpus, self.memory_mb, self.cpu_seconds, self.cache,
+                                           animations, output_path)
+
+            output_path = output_path or default_output_path(filepath, class_name, media_dir, quality)
+            config = {"media_dir": media_dir, "quality": quality, "output_file": os.path.abspath(output_path)}
+            if animations:
+                config["from_animation_number"] = animations[0]
+                if animations[1] is not None:
+                    config["upto_animation_number"] = animations[1]
+            reply = self._send(filepath, class_name, config)
+            if reply is None:
+                return None, None
+            _report_cache(class_name, reply.get("cache"))
+            return reply["video_path"], reply["error"]
+
+    def dry_run(self, filepath, class_name, media_dir=None):
+        """Run the scene's construct() with every animation skipped and nothing written.
+
+        Takes a fraction of the render time and raises the same exceptions a
+        render would, apart from those in frame drawing itself. Without a warm
+        worker, manim --dry_run is run instead.
+
+        Returns a dict with "error" (the traceback, or None), "num_plays" and
+        "duration" (seconds of video; both None from the manim command), or
+        None when Manim could not run at all. A dry run that does not finish
+        within DRY_RUN_TIMEOUT is reported as an error.
+        """
+        with self._lock:
+            if self._process is None and not (self.warm and self._start()):
+                return dry_run_with_command(filepath, class_name, media_dir, DRY_RUN_TIMEOUT, self.cpus,
+                                            self.memory_mb, self.cpu_seconds)
+            config = dict(DRY_RUN_CONFIG)
+            if media_dir:
+                config["media_dir"] = media_dir
+            reply = self._send(filepath, class_name, config, timeout=DRY_RUN_TIMEOUT)
+            if reply is None:
+                return {"error": _dry_run_timeout_error(class_name), "num_plays": None, "duration": None}
+            return {"error": reply["error"], "num_plays": reply.get("num_plays"), "duration": reply.get("duration")}
+
+    def close(self):
+        with self._lock:
+            self._stop()
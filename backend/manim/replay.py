@@ -0,0 +1,445 @@
+"""Offline LLM backend that replays responses recorded in *_artifacts directories.
+
+The stage of each request is recognised from its system prompt and the topic
+from the <math_topic>/<topic> tag in the user message. The matching artifact
+(01_concept_analysis.txt ... 04_code.py) is then replayed with synthetic
+latency and, optionally, injected API errors. Topics without a recording are
+mapped onto a recorded one deterministically.
+
+In-process use:
+
+    backend = ReplayBackend("content/videos_dir", tokens_per_second=80)
+    generator = ManimGenerator(client=backend.client())
+
+As a local stand-in for the messages API, for tests that go through the real
+SDK and HTTP stack:
+
+    python replay.py --port 8765 --error-rate 0.05
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8765 python main.py --topic "eigenvectors"
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import anthropic
+
+from prompts import (CONCEPT_BREAKDOWN_SYSTEM, DESIGN_SYSTEM, ANIMATION_TESTING_SYSTEM,
+                     CODE_GENERATION_SYSTEM, CODE_REPAIR_SYSTEM, FUSED_ANALYSIS_SYSTEM,
+                     RENDER_FIX_SYSTEM)
+from rate_limit import estimate_tokens
+
+# Artifact files replayed for each stage, keyed by the stage's system prompt
+STAGE_ARTIFACTS = {
+    CONCEPT_BREAKDOWN_SYSTEM: ("01_concept_analysis.txt",),
+    DESIGN_SYSTEM: ("02_animation_design.txt",),
+    ANIMATION_TESTING_SYSTEM: ("03_design_testing.txt",),
+    FUSED_ANALYSIS_SYSTEM: ("01_concept_analysis.txt", "02_animation_design.txt", "03_design_testing.txt"),
+    CODE_GENERATION_SYSTEM: ("04_code.py",),
+    CODE_REPAIR_SYSTEM: ("04_code.py",),
+}
+
+ERROR_TYPES = {429: "rate_limit_error", 500: "api_error", 503: "api_error", 529: "overloaded_error"}
+
+# Characters per streamed text delta
+CHUNK_CHARS = 40
+
+
+class InjectedAPIError(anthropic.APIStatusError):
+    """An API error raised by the in-process replay client.
+
+    Carries status_code and a response with headers, which is all the retry
+    logic reads, without needing a real HTTP response.
+    """
+
+    def __init__(self, status_code, retry_after=None):
+        message = f"Injected replay error ({status_code} {ERROR_TYPES.get(status_code, 'api_error')})"
+        Exception.__init__(self, message)
+        self.message = message
+        self.status_code = status_code
+        self.body = None
+        self.request = None
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+class ReplayResponse:
+    """One replayed message: text chunks, stop reason, usage and timing"""
+
+    def __init__(self, model, chunks, stop_reason, stop_sequence, input_tokens, output_tokens,
+                 first_token_delay, chunk_delay):
+        self.model = model
+        self.chunks = chunks
+        self.stop_reason = stop_reason
+        self.stop_sequence = stop_sequence
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+
+    @property
+    def total_delay(self):
+        return self.first_token_delay + self.chunk_delay * len(self.chunks)
+
+    def _usage(self, output_tokens):
+        return {
+            "input_tokens": self.input_tokens,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+            "output_tokens": output_tokens,
+        }
+
+    def message(self):
+        """The complete response as a messages API JSON object"""
+        return {
+            "id": "msg_replay",
+            "type": "message",
+            "role": "assistant",
+            "model": self.model,
+            "content": [{"type": "text", "text": "".join(self.chunks)}],
+            "stop_reason": self.stop_reason,
+            "stop_sequence": self.stop_sequence,
+            "usage": self._usage(self.output_tokens),
+        }
+
+    def events(self):
+        """The response as (delay before event, streaming event) pairs"""
+        start = self.message()
+        start.update(content=[], stop_reason=None, stop_sequence=None, usage=self._usage(1))
+        events = [
+            (0.0, {"type": "message_start", "message": start}),
+            (0.0, {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+        ]
+        for index, chunk in enumerate(self.chunks):
+            delay = self.first_token_delay if index == 0 else self.chunk_delay
+            events.append((delay, {"type": "content_block_delta", "index": 0,
+                                   "delta": {"type": "text_delta", "text": chunk}}))
+        events += [
+            (0.0, {"type": "content_block_stop", "index": 0}),
+            (0.0, {"type": "message_delta",
+                   "delta": {"stop_reason": self.stop_reason, "stop_sequence": self.stop_sequence},
+                   "usage": {"output_tokens": self.output_tokens}}),
+            (0.0, {"type": "message_stop"}),
+        ]
+        return events
+
+
+class ReplayBackend:
+    """Answers messages API requests from recorded pipeline artifacts.
+
+    Latency is time_to_first_token plus output tokens / tokens_per_second, each
+    scaled by a random factor within +/- jitter. error_rate is the probability
+    that a request fails with error_status instead (retry_after, when set, is
+    sent as the retry-after header). Pass seed for reproducible runs.
+    """
+
+    def __init__(self, artifacts_root, time_to_first_token=0.5, tokens_per_second=60.0, jitter=0.1,
+                 error_rate=0.0, error_status=529, retry_after=None, seed=None):
+        self.artifacts_root = artifacts_root
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._texts = {}
+        self.topics = sorted(
+            name[:-len("_artifacts")]
+            for name in os.listdir(artifacts_root)
+            if name.endswith("_artifacts") and os.path.isdir(os.path.join(artifacts_root, name))
+        )
+        if not self.topics:
+            raise ValueError(f"No *_artifacts directories found in {artifacts_root}")
+        print(f"Replay backend: {len(self.topics)} recorded topics in {artifacts_root}")
+
+    def client(self):
+        """A drop-in for anthropic.Anthropic"""
+        return ReplayClient(self)
+
+    def async_client(self):
+        """A drop-in for anthropic.AsyncAnthropic"""
+        return AsyncReplayClient(self)
+
+    def _read(self, topic, filename):
+        key = (topic, filename)
+        if key not in self._texts:
+            path = os.path.join(self.artifacts_root, f"{topic}_artifacts", filename)
+            try:
+                with open(path, 'r') as f:
+                    self._texts[key] = f.read()
+            except OSError:
+                self._texts[key] = ""
+        return self._texts[key]
+
+    def _recorded_topic(self, prompt):
+        """Map the requested topic onto a recorded one, by name when possible"""
+        match = re.search(r'<(?:math_topic|topic)>\s*(.*?)\s*</(?:math_topic|topic)>', prompt, re.DOTALL)
+        topic = match.group(1) if match else ""
+        safe_topic = topic.lower().replace(' ', '_').replace('/', '_').replace('\\', '_').replace(':', '_')
+        if safe_topic in self.topics:
+            return safe_topic
+        return self.topics[zlib.crc32(safe_topic.encode("utf-8")) % len(self.topics)]
+
+    def _recorded_text(self, system, prompt):
+        if system == RENDER_FIX_SYSTEM:
+            # Nothing recorded to replay; an empty fix makes the caller give up cleanly
+            return "<PATCHES_END>"
+
+        filenames = STAGE_ARTIFACTS.get(system)
+        if not filenames:
+            return ""
+        topic = self._recorded_topic(prompt)
+        if filenames != ("04_code.py",):
+            return "\n\n".join(self._read(topic, filename) for filename in filenames)
+
+        # Rename the recorded scene to the requested class so topic validation passes
+        code = self._read(topic, "04_code.py")
+        class_name = re.search(r'<class_name>\s*(\w+)\s*</class_name>', prompt)
+        if class_name:
+            code = re.sub(r'class\s+\w+\s*\(\s*Scene\s*\)', f"class {class_name.group(1)}(Scene)", code, count=1)
+        return f"<CODE_START>\n{code}\n<CODE_END>"
+
+    def _scaled(self, value):
+        with self._lock:
+            return value * (1 + self._random.uniform(-self.jitter, self.jitter))
+
+    def injected_error(self):
+        """Return the status code to fail this request with, or None"""
+        with self._lock:
+            failed = self.error_rate and self._random.random() < self.error_rate
+        return self.error_status if failed else None
+
+    def respond(self, request):
+        """Build the replayed response for a messages API request body"""
+        system = request.get("system") or ""
+        if isinstance(system, list):
+            system = "".join(block.get("text", "") for block in system)
+        messages = request.get("messages", [])
+        prompt = next((m["content"] for m in messages if m["role"] == "user"), "")
+        if not isinstance(prompt, str):
+            prompt = "".join(block.get("text", "") for block in prompt)
+
+        text = self._recorded_text(system, prompt)
+
+        # Continuation requests end with the truncated response as an assistant prefill
+        if messages and messages[-1]["role"] == "assistant":
+            prefill = messages[-1]["content"]
+            text = text[len(prefill):] if text.startswith(prefill) else text
+
+        stop_reason, stop_sequence = "end_turn", None
+        for sequence in request.get("stop_sequences") or []:
+            index = text.find(sequence)
+            if index != -1:
+                text, stop_reason, stop_sequence = text[:index], "stop_sequence", sequence
+
+        max_tokens = request.get("max_tokens", 4096)
+        if len(text) > max_tokens * 4:
+            text, stop_reason, stop_sequence = text[:max_tokens * 4], "max_tokens", None
+
+        output_tokens = min(estimate_tokens(text), max_tokens)
+        generation_time = output_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+        chunks = [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)]
+        return ReplayResponse(
+            model=request.get("model", "replay"),
+            chunks=chunks,
+            stop_reason=stop_reason,
+            stop_sequence=stop_sequence,
+            input_tokens=estimate_tokens(system, prompt),
+            output_tokens=output_tokens,
+            first_token_delay=self._scaled(self.time_to_first_token),
+            chunk_delay=self._scaled(generation_time / len(chunks)) if chunks else 0.0,
+        )
+
+
+def _namespace(value):
+    """Turn decoded JSON into attribute-access objects shaped like the SDK's models"""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+# -----------------------------------------------------------------------------
+# In-process clients
+# -----------------------------------------------------------------------------
+
+class _Stream:
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        for delay, event in self.response.events():
+            if delay:
+                time.sleep(delay)
+            yield _namespace(event)
+
+    def close(self):
+        pass
+
+
+class _AsyncStream(_Stream):
+    async def __aiter__(self):
+        for delay, event in self.response.events():
+            if delay:
+                await asyncio.sleep(delay)
+            yield _namespace(event)
+
+    async def close(self):
+        pass
+
+
+class _Messages:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _respond(self, request):
+        status = self.backend.injected_error()
+        if status:
+            raise InjectedAPIError(status, self.backend.retry_after)
+        return self.backend.respond(request)
+
+    def create(self, stream=False, **request):
+        response = self._respond(request)
+        if stream:
+            return _Stream(response)
+        time.sleep(response.total_delay)
+        return _namespace(response.message())
+
+
+class _AsyncMessages(_Messages):
+    async def create(self, stream=False, **request):
+        response = self._respond(request)
+        if stream:
+            return _AsyncStream(response)
+        await asyncio.sleep(response.total_delay)
+        return _namespace(response.message())
+
+
+class ReplayClient:
+    def __init__(self, backend):
+        self.messages = _Messages(backend)
+
+    def close(self):
+        pass
+
+
+class AsyncReplayClient:
+    def __init__(self, backend):
+        self.messages = _AsyncMessages(backend)
+
+    async def close(self):
+        pass
+
+
+# -----------------------------------------------------------------------------
+# HTTP stand-in for the messages API
+# -----------------------------------------------------------------------------
+
+def make_handler(backend):
+    class ReplayHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_POST(self):
+            if self.path.split("?")[0].rstrip("/") != "/v1/messages":
+                self._send_json(404, {"type": "error", "error": {"type": "not_found_error",
+                                                                  "message": f"Unknown path {self.path}"}})
+                return
+            length = int(self.headers.get("content-length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            status = backend.injected_error()
+            if status:
+                headers = {"retry-after": str(backend.retry_after)} if backend.retry_after is not None else {}
+                self._send_json(status, {"type": "error", "error": {
+                    "type": ERROR_TYPES.get(status, "api_error"),
+                    "message": "Injected replay error"
+                }}, headers)
+                return
+
+            response = backend.respond(request)
+            if not request.get("stream"):
+                time.sleep(response.total_delay)
+                self._send_json(200, response.message())
+                return
+
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.send_header("cache-control", "no-cache")
+            self.send_header("connection", "close")
+            self.end_headers()
+            try:
+                for delay, event in response.events():
+                    if delay:
+                        time.sleep(delay)
+                    self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client closed the stream early, e.g. after <CODE_END>
+                pass
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            print(f"[replay] {self.address_string()} {format % args}")
+
+    return ReplayHandler
+
+
+def serve(backend, host="127.0.0.1", port=8765):
+    """Serve the replay backend at http://host:port/v1/messages until interrupted"""
+    server = ThreadingHTTPServer((host, port), make_handler(backend))
+    print(f"Replay messages API listening on http://{host}:{port} "
+          f"(set ANTHROPIC_BASE_URL to use it)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Replay recorded pipeline responses as a local messages API")
+    parser.add_argument("--artifacts", type=str, default=os.path.join(curr_dir, "content", "videos_dir"),
+                        help="Directory containing <topic>_artifacts directories")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the first token")
+    parser.add_argument("--tps", type=float, default=60.0, help="Output tokens per second (0 for no delay)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Random +/- fraction applied to latencies")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=529, help="HTTP status of injected failures")
+    parser.add_argument("--retry-after", type=float, default=None, help="retry-after header for failures")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible latency and errors")
+    args = parser.parse_args()
+
+    serve(ReplayBackend(
+        args.artifacts,
+        time_to_first_token=args.ttft,
+        tokens_per_second=args.tps,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        seed=args.seed
+    ), args.host, args.port)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ResponseCache:
+    """Content-addressed on-disk cache for LLM responses.
+
+    Each response is stored as its own JSON file named after the SHA-256 of the
+    request parameters. The file modification time doubles as the last-access
+    time, so eviction is least-recently-used without a separate index.
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, ttl_seconds=7 * 24 * 3600,
+                 cache_only=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.cache_only = cache_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(**request):
+        """Hash the request parameters into a stable cache key"""
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Return the cached response for key, or None on a miss or expired entry"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if self.ttl_seconds and time.time() - entry.get("created", 0) > self.ttl_seconds:
+            self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Touch the file so eviction treats it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return entry.get("response")
+
+    def put(self, key, response, **metadata):
+        """Store a response and evict old entries if the cache is over its size limit"""
+        if response is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {"created": time.time(), "response": response, "metadata": metadata}
+
+        # Write to a temp file first so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan_size()
+            else:
+                self._total_bytes += os.path.getsize(path)
+            if self.max_bytes and self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_mtime, stat.st_size
+
+    def _scan_size(self):
+        return sum(size for _, _, size in self._entries())
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Delete least-recently-used entries until the cache is under 90% of max_bytes"""
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for path, _, size in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+        self._total_bytes = total
+        if evicted:
+            print(f"Response cache evicted {evicted} entries ({total} bytes remaining)")
+
+    def stats(self):
+        """Return hit/miss counters and current cache size"""
+        entries = list(self._entries())
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(entries),
+            "bytes": sum(size for _, _, size in entries),
+        }
@@ -0,0 +1,415 @@
+import ast
+import builtins
+import difflib
+import importlib.metadata
+import inspect
+import json
+import os
+import sys
+import threading
+
+# Bump when the index layout changes so old index files are rebuilt
+INDEX_VERSION = 1
+
+
+def _signature_entry(function, skip_self=False):
+    """Describe the parameters of a callable for call checking"""
+    try:
+        signature = inspect.signature(function)
+    except (TypeError, ValueError):
+        return {"params": [], "required": [], "max_positional": None, "any_keyword": True}
+
+    params = list(signature.parameters.values())
+    if skip_self and params and params[0].kind in (params[0].POSITIONAL_ONLY, params[0].POSITIONAL_OR_KEYWORD):
+        params = params[1:]
+    positional = [p for p in params if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    return {
+        "params": [p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)],
+        "required": [p.name for p in params
+                     if p.default is p.empty and p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)],
+        "max_positional": None if any(p.kind == p.VAR_POSITIONAL for p in params) else len(positional),
+        "any_keyword": any(p.kind == p.VAR_KEYWORD for p in params),
+    }
+
+
+def _class_entry(cls, scene_base):
+    """Describe the constructor of a class, following **kwargs up the MRO"""
+    inits = [klass.__dict__["__init__"] for klass in cls.__mro__
+             if klass is not object and "__init__" in klass.__dict__]
+    if not inits:
+        entry = {"params": [], "required": [], "max_positional": 0, "any_keyword": False}
+    else:
+        entry = _signature_entry(inits[0], skip_self=True)
+        # Keyword arguments an __init__ does not take itself are passed to its
+        # parent's, so the accepted keywords are the union along the MRO until an
+        # __init__ without **kwargs
+        params = list(entry["params"])
+        any_keyword = True
+        for init in inits:
+            parent = _signature_entry(init, skip_self=True)
+            params.extend(p for p in parent["params"] if p not in params)
+            if not parent["any_keyword"]:
+                any_keyword = False
+                break
+        entry["params"] = params
+        entry["any_keyword"] = any_keyword
+
+    entry["kind"] = "class"
+    entry["scene"] = scene_base is not None and issubclass(cls, scene_base)
+    if entry["scene"]:
+        entry["members"] = sorted(name for name in dir(cls) if not name.startswith("__"))
+    return entry
+
+
+def build_index():
+    """Introspect the installed manim package; returns the index dict"""
+    import manim
+
+    symbols = {}
+    scene_base = getattr(manim, "Scene", None)
+    for name in dir(manim):
+        if name.startswith("_"):
+            continue
+        obj = getattr(manim, name)
+        if inspect.ismodule(obj):
+            symbols[name] = {"kind": "module"}
+        elif inspect.isclass(obj):
+            symbols[name] = _class_entry(obj, scene_base)
+        elif callable(obj):
+            symbols[name] = dict(_signature_entry(obj), kind="function")
+        else:
+            symbols[name] = {"kind": "value"}
+    return {"index_version": INDEX_VERSION, "manim_version": manim.__version__, "symbols": symbols}
+
+
+class ManimAPIIndex:
+    """Public names and signatures of the installed Manim, cached in a JSON file.
+
+    Importing and introspecting manim takes seconds, so the index is built once
+    per installed version and loaded from index_file afterwards. When manim is
+    not installed in this interpreter the index is unavailable and the checks
+    that need it are skipped.
+    """
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._lock = threading.Lock()
+        self._symbols = None
+        self._loaded = False
+
+    @property
+    def symbols(self):
+        """Map of manim's public names to their descriptions, or None without manim"""
+        with self._lock:
+            if not self._loaded:
+                self._symbols = self._load()
+                self._loaded = True
+            return self._symbols
+
+    def _load(self):
+        try:
+            version = importlib.metadata.version("manim")
+        except importlib.metadata.PackageNotFoundError:
+            print("Manim is not installed here; static checks skip the API index")
+            return None
+
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            if index.get("index_version") == INDEX_VERSION and index.get("manim_version") == version:
+                return index["symbols"]
+        except (OSError, ValueError, AttributeError, KeyError):
+            pass
+
+        print(f"Building Manim API index for manim {version}...")
+        try:
+            index = build_index()
+        except Exception as e:
+            print(f"Could not build Manim API index: {e}")
+            return None
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+            tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_file)
+        except OSError as e:
+            print(f"Could not save Manim API index: {e}")
+        return index["symbols"]
+
+
+class _Bindings(ast.NodeVisitor):
+    """Every name the module binds anywhere, and what it imports from manim"""
+
+    def __init__(self):
+        self.bound = {}
+        self.manim_imports = {}
+        self.manim_star = False
+        self.other_star = False
+        self.self_attributes = set()
+
+    def bind(self, name, node):
+        self.bound.setdefault(name, node.lineno if hasattr(node, "lineno") else 0)
+
+    def visit_Name(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self.bind(node.id, node)
+
+    def visit_arg(self, node):
+        self.bind(node.arg, node)
+
+    def visit_FunctionDef(self, node):
+        self.bind(node.name, node)
+        self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):
+        self.bind(node.name, node)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.bind(alias.asname or alias.name.split(".")[0], node)
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == "*":
+                if node.module == "manim":
+                    self.manim_star = True
+                else:
+                    self.other_star = True
+            elif node.module == "manim":
+                self.manim_imports[alias.asname or alias.name] = (alias.name, node.lineno)
+            else:
+                self.bind(alias.asname or alias.name, node)
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.bind(node.name, node)
+        self.generic_visit(node)
+
+    def visit_Global(self, node):
+        for name in node.names:
+            self.bind(name, node)
+
+    visit_Nonlocal = visit_Global
+
+    def visit_Attribute(self, node):
+        if (isinstance(node.ctx, ast.Store) and isinstance(node.value, ast.Name)
+                and node.value.id == "self"):
+            self.self_attributes.add(node.attr)
+        self.generic_visit(node)
+
+    def generic_visit(self, node):
+        # Names bound by match patterns
+        name = getattr(node, "name", None) if type(node).__name__.startswith("Match") else None
+        if isinstance(name, str):
+            self.bind(name, node)
+        super().generic_visit(node)
+
+
+def _suggest(name, candidates):
+    matches = difflib.get_close_matches(name, candidates, n=1, cutoff=0.75)
+    return f" (did you mean '{matches[0]}'?)" if matches else ""
+
+
+def _scene_classes(tree, symbols):
+    """Map each module class that derives from a Manim scene to its ClassDef"""
+    classes = {node.name: node for node in tree.body if isinstance(node, ast.ClassDef)}
+    scenes = {}
+
+    def is_scene(name, seen=()):
+        if name in classes and name not in seen:
+            return any(is_scene(base, seen + (name,)) for base in _base_names(classes[name]))
+        if symbols is not None:
+            return bool(symbols.get(name, {}).get("scene"))
+        return name.endswith("Scene")
+
+    for name, node in classes.items():
+        if any(is_scene(base) for base in _base_names(node)):
+            scenes[name] = node
+    return scenes, classes
+
+
+def _base_names(node):
+    return [base.id if isinstance(base, ast.Name) else base.attr
+            for base in node.bases if isinstance(base, (ast.Name, ast.Attribute))]
+
+
+def _class_methods(name, classes, seen=()):
+    """Names defined in a module class body and in its module base classes"""
+    if name not in classes or name in seen:
+        return set()
+    node = classes[name]
+    names = set()
+    for item in node.body:
+        if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(item.name)
+        elif isinstance(item, (ast.Assign, ast.AnnAssign)):
+            targets = item.targets if isinstance(item, ast.Assign) else [item.target]
+            names.update(t.id for t in targets if isinstance(t, ast.Name))
+    for base in _base_names(node):
+        names |= _class_methods(base, classes, seen + (name,))
+    return names
+
+
+def _manim_bases(name, classes, symbols, seen=()):
+    """The Manim classes a module class ultimately derives from"""
+    if name not in classes:
+        return [name] if name in symbols else []
+    if name in seen:
+        return []
+    bases = []
+    for base in _base_names(classes[name]):
+        bases.extend(_manim_bases(base, classes, symbols, seen + (name,)))
+    return bases
+
+
+def _check_call(node, name, entry, problems):
+    """Check a call against the parameters recorded for a Manim callable"""
+    if any(isinstance(arg, ast.Starred) for arg in node.args) or any(kw.arg is None for kw in node.keywords):
+        return
+
+    keywords = [kw.arg for kw in node.keywords]
+    if not entry.get("any_keyword"):
+        for keyword in keywords:
+            if keyword not in entry["params"]:
+                problems.append((node.lineno, f"{name}() got an unexpected keyword argument "
+                                              f"'{keyword}'{_suggest(keyword, entry['params'])}"))
+
+    max_positional = entry.get("max_positional")
+    if max_positional is not None and len(node.args) > max_positional:
+        problems.append((node.lineno, f"{name}() takes {max_positional} positional arguments "
+                                      f"but {len(node.args)} were given"))
+
+    positional_params = entry["params"][:len(node.args)]
+    missing = [p for p in entry["required"] if p not in positional_params and p not in keywords]
+    if missing:
+        problems.append((node.lineno, f"{name}() is missing required arguments: {', '.join(missing)}"))
+
+
+def check_scene(code, class_name=None, index=None):
+    """Statically check generated Manim code before it is rendered
+
+    Finds syntax errors, a missing Scene subclass or construct method, names
+    that are never defined or imported, and calls to Manim classes and
+    functions with unknown keywords or the wrong number of arguments. The
+    last two need the API index; without one only names from modules other
+    than manim are checked.
+
+    Args:
+        code: The generated code
+        class_name: The scene class that will be rendered, if known
+        index: A ManimAPIIndex, or None to skip the checks that need it
+
+    Returns:
+        A dict with "ok" (no problems were found), "problems" (a list of
+        "line N: message" strings) and "checked_api" (the index was used)
+    """
+    symbols = index.symbols if index is not None else None
+    result = {"ok": True, "problems": [], "checked_api": symbols is not None}
+    problems = []
+
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        result["ok"] = False
+        result["problems"].append(f"line {e.lineno}: SyntaxError: {e.msg}")
+        return result
+
+    bindings = _Bindings()
+    bindings.visit(tree)
+
+    # The scene class and its construct method
+    scenes, classes = _scene_classes(tree, symbols)
+    if class_name and class_name not in scenes:
+        if class_name in classes:
+            problems.append((classes[class_name].lineno, f"class {class_name} does not derive from Scene"))
+        else:
+            problems.append((1, f"class {class_name} is not defined"))
+    elif not scenes:
+        problems.append((1, "no Scene subclass is defined"))
+    elif class_name:
+        if "construct" not in _class_methods(class_name, classes):
+            problems.append((scenes[class_name].lineno, f"class {class_name} has no construct method"))
+    elif not any("construct" in _class_methods(name, classes) for name in scenes):
+        problems.append((min(node.lineno for node in scenes.values()), "no Scene subclass has a construct method"))
+
+    # Imports of names manim does not have
+    if symbols is not None:
+        for local_name, (name, lineno) in bindings.manim_imports.items():
+            if name not in symbols:
+                problems.append((lineno, f"cannot import name '{name}' from 'manim'{_suggest(name, symbols)}"))
+
+    # Names that are used but never bound. Without the index a star import
+    # from manim can provide any name, and any other star import always can
+    manim_names = set(bindings.manim_imports)
+    if bindings.manim_star and symbols is not None:
+        manim_names |= set(symbols)
+    known = set(bindings.bound) | manim_names | set(dir(builtins)) | {"__file__", "__name__"}
+    check_names = not bindings.other_star and (not bindings.manim_star or symbols is not None)
+
+    reported = set()
+    for node in ast.walk(tree):
+        if check_names and isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            if node.id not in known and node.id not in reported:
+                reported.add(node.id)
+                problems.append((node.lineno, f"name '{node.id}' is not defined{_suggest(node.id, known)}"))
+
+        if symbols is None or not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name):
+            continue
+        # Calls of Manim classes and functions the module does not shadow
+        name = node.func.id
+        manim_name = bindings.manim_imports.get(name, (name, 0))[0]
+        if name in manim_names and name not in bindings.bound:
+            entry = symbols.get(manim_name)
+            if entry and entry.get("kind") in ("class", "function"):
+                _check_call(node, name, entry, problems)
+
+    # self.<method>() calls in a scene must be defined by the class or by Manim
+    if symbols is not None:
+        for name, node in scenes.items():
+            own = _class_methods(name, classes) | bindings.self_attributes
+            members = set()
+            for base in _manim_bases(name, classes, symbols):
+                members |= set(symbols.get(base, {}).get("members", []))
+            if not members:
+                continue
+            for call in ast.walk(node):
+                if (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)
+                        and isinstance(call.func.value, ast.Name) and call.func.value.id == "self"):
+                    attr = call.func.attr
+                    if attr not in own and attr not in members:
+                        problems.append((call.lineno, f"'{name}' object has no attribute "
+                                                      f"'{attr}'{_suggest(attr, members)}"))
+
+    problems.sort()
+    result["problems"] = [f"line {line}: {message}" for line, message in problems]
+    result["ok"] = not problems
+    return result
+
+
+def format_problems(result):
+    """Describe the problems found by check_scene as an error report for a render fix"""
+    return "Static check of the scene found these problems before rendering:\n" + "\n".join(result["problems"])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Statically check a generated Manim scene")
+    parser.add_argument("file", help="Python file to check")
+    parser.add_argument("class_name", nargs="?", default=None, help="Scene class that will be rendered")
+    parser.add_argument("--index", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        "content", "manim_api_index.json"),
+                        help="Manim API index file (built on first use)")
+    args = parser.parse_args()
+
+    with open(args.file, 'r') as f:
+        check = check_scene(f.read(), args.class_name, ManimAPIIndex(args.index))
+    if check["ok"]:
+        print(f"OK (API index {'used' if check['checked_api'] else 'unavailable'})")
+    else:
+        print("\n".join(check["problems"]))
+    sys.exit(0 if check["ok"] else 1)
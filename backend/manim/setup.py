@@ -1,74 +1,345 @@
+import asyncio
+import time
 import anthropic
-from prompts import (CONCEPT_BREAKDOWN, ANIMATION_TESTING, DESIGN, 
-                   CODE_GENERATION, 
-                   extract_code_only, extract_section)
+from metrics import record_call
+from rate_limit import estimate_tokens, is_retryable
+from prompts import (CONCEPT_BREAKDOWN, ANIMATION_TESTING, DESIGN,
+                   CODE_GENERATION, CONCEPT_BREAKDOWN_SYSTEM, DESIGN_SYSTEM,
+                   ANIMATION_TESTING_SYSTEM, CODE_GENERATION_SYSTEM,
+                   FUSED_ANALYSIS, FUSED_ANALYSIS_SYSTEM, CODE_REPAIR, CODE_REPAIR_SYSTEM,
+                   RENDER_FIX, RENDER_FIX_SYSTEM, apply_patches,
+                   PROMPT_VERSION, SectionWatcher,
+                   extract_code_only, parse_sections)
+
+# Closing marker after which a code generation response is no longer needed
+CODE_STOP = ["<CODE_END>"]
+
+# Closing marker of a render fix response
+PATCH_STOP = ["<PATCHES_END>"]
+
+# Manim tracebacks are long and the actual exception is at the end
+RENDER_ERROR_CHARS = 4000
+
+# Follow-up requests allowed for a response that stops at max_tokens
+MAX_CONTINUATIONS = 2
+
+USAGE_FIELDS = ("input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens", "output_tokens")
+
+def _usage_dict(usage):
+    """Copy the token counts we report from an API usage object"""
+    if usage is None:
+        return {}
+    return {field: getattr(usage, field, None) or 0 for field in USAGE_FIELDS}
+
+class _StreamedResponse:
+    """Accumulates text, usage and timing from streamed message events"""
+    
+    def __init__(self, stop_after):
+        self.stop_after = stop_after
+        self.watcher = SectionWatcher(stop_after)
+        self.chunks = []
+        self.info = {"stop_reason": None, "time_to_first_token": None}
+        self.stop_sequence = None
+        self.started = time.monotonic()
+    
+    def handle(self, event):
+        """Process one stream event; returns True once the caller can stop reading"""
+        if event.type == "message_start":
+            self.info.update(_usage_dict(event.message.usage))
+        elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+            if self.info["time_to_first_token"] is None:
+                self.info["time_to_first_token"] = time.monotonic() - self.started
+            self.chunks.append(event.delta.text)
+            if self.watcher.feed(event.delta.text):
+                print(f"All required sections closed ({', '.join(self.stop_after)}) - stopping stream early")
+                self.info["stop_reason"] = "early_stop"
+                return True
+        elif event.type == "message_delta":
+            if event.usage is not None:
+                self.info["output_tokens"] = event.usage.output_tokens
+            self.info["stop_reason"] = event.delta.stop_reason
+            if event.delta.stop_reason == "stop_sequence":
+                self.stop_sequence = event.delta.stop_sequence
+        return False
+    
+    def result(self):
+        # The stop sequence itself is not part of the streamed text
+        if self.stop_sequence:
+            self.chunks.append(self.stop_sequence)
+        return "".join(self.chunks), self.info
 
 class ManimGenerator:
-    def __init__(self, api_key=None):
-        self.client = anthropic.Anthropic(api_key=api_key)
+    def __init__(self, api_key=None, cache=None, streaming=True, rate_limiter=None, token_budget=None,
+                 client=None):
+        # With a shared RateLimiter, retries are scheduled by the limiter instead of the SDK
+        self.rate_limiter = rate_limiter
+        # client replaces the Anthropic client, e.g. with a replay.ReplayBackend client
+        self.client = client or self._create_client(api_key, max_retries=0 if rate_limiter else 2)
         self.model = "claude-3-7-sonnet-20250219"
-        print(f"Initialized ManimGenerator with model: {self.model}")
+        # Optional ResponseCache; when cache.cache_only is set no API calls are made
+        self.cache = cache
+        # Stream responses so requests can stop as soon as the needed sections close
+        self.streaming = streaming
+        # Optional TokenBudget that sizes max_tokens per stage from past responses
+        self.token_budget = token_budget
+        print(f"Initialized ManimGenerator with model: {self.model} (streaming={self.streaming})")
+        if self.cache:
+            mode = "cache-only" if self.cache.cache_only else "read-through"
+            print(f"Response cache enabled ({mode}) at {self.cache.cache_dir}")
     
-    def _send_prompt(self, prompt, max_tokens=3000):
-        """Helper method to send a prompt to the API and get the text response"""
+    def _create_client(self, api_key, max_retries):
+        return anthropic.Anthropic(api_key=api_key, max_retries=max_retries)
+    
+    def _build_request(self, prompt, max_tokens, stop_after=None, system=None, prefill=None):
+        request = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "messages": [{
+                "role": "user",
+                "content": prompt
+            }]
+        }
+        if prefill:
+            # Continue a truncated response from where it stopped
+            request["messages"].append({
+                "role": "assistant",
+                "content": prefill
+            })
+        if system:
+            # The static instructions are identical across topics, so mark them
+            # as a cacheable prefix for provider-side prompt caching
+            request["system"] = [{
+                "type": "text",
+                "text": system,
+                "cache_control": {"type": "ephemeral"}
+            }]
+        if stop_after and len(stop_after) == 1:
+            request["stop_sequences"] = list(stop_after)
+        return request
+    
+    def _message_text(self, message):
+        """Get the text content and call info from a complete (non-streamed) response"""
+        content_text = ""
+        for content_block in message.content:
+            if content_block.type == "text":
+                content_text += content_block.text
+        # The stop sequence itself is not part of the returned text
+        if message.stop_reason == "stop_sequence" and message.stop_sequence:
+            content_text += message.stop_sequence
+        info = _usage_dict(message.usage)
+        info.update(stop_reason=message.stop_reason, time_to_first_token=None)
+        return content_text, info
+    
+    def _request(self, prompt, max_tokens, stop_after=None, system=None, prefill=None):
+        """Send a single request and return (response text, call info).
+        
+        The call info holds token usage, the stop reason and, when streaming,
+        the time to the first token.
+        
+        stop_after lists closing markers (e.g. "<CODE_END>") after which the rest
+        of the completion is not needed. A single marker is also passed as a stop
+        sequence so generation ends server-side; with streaming enabled the
+        stream is closed as soon as every marker has been seen.
+        
+        prefill is earlier response text the model should continue from.
+        """
+        request = self._build_request(prompt, max_tokens, stop_after, system, prefill)
+        
+        if not self.streaming:
+            message = self.client.messages.create(**request)
+            return self._message_text(message)
+        
+        response = _StreamedResponse(stop_after)
+        stream = self.client.messages.create(stream=True, **request)
+        try:
+            for event in stream:
+                if response.handle(event):
+                    break
+        finally:
+            # Closing the stream aborts the HTTP request and stops generation
+            stream.close()
+        return response.result()
+    
+    def _request_with_retries(self, prompt, max_tokens, stop_after=None, system=None, prefill=None):
+        """Send a request through the rate limiter, backing off on 429/529 responses"""
+        if not self.rate_limiter:
+            return self._request(prompt, max_tokens, stop_after, system, prefill)
+        
+        estimated = estimate_tokens(system, prompt, prefill)
+        for attempt in range(self.rate_limiter.max_retries + 1):
+            self.rate_limiter.acquire(estimated)
+            try:
+                content_text, info = self._request(prompt, max_tokens, stop_after, system, prefill)
+            except anthropic.APIStatusError as e:
+                if not is_retryable(e) or attempt == self.rate_limiter.max_retries:
+                    raise
+                time.sleep(self.rate_limiter.backoff(attempt, e))
+                continue
+            self.rate_limiter.record_usage(estimated, info.get("input_tokens", 0)
+                                           + info.get("cache_creation_input_tokens", 0))
+            return content_text, info
+    
+    def _continuation_prefill(self, content_text, info):
+        print(f"Response hit max_tokens after {info.get('output_tokens', 0)} output tokens - "
+              f"requesting a continuation")
+        # The API rejects an assistant prefill that ends in whitespace
+        return content_text.rstrip()
+    
+    def _merge_continuation(self, prefill, info, more_text, more_info):
+        """Join a continuation onto the truncated response and add up its usage"""
+        merged = dict(more_info)
+        for field in USAGE_FIELDS:
+            merged[field] = (info.get(field) or 0) + (more_info.get(field) or 0)
+        merged["time_to_first_token"] = info.get("time_to_first_token")
+        merged["continuations"] = info.get("continuations", 0) + 1
+        return prefill + more_text, merged
+    
+    def _request_complete(self, prompt, max_tokens, stop_after=None, system=None):
+        """Send a request and continue the response while it stops at max_tokens"""
+        content_text, info = self._request_with_retries(prompt, max_tokens, stop_after, system)
+        for _ in range(MAX_CONTINUATIONS):
+            if info.get("stop_reason") != "max_tokens":
+                break
+            prefill = self._continuation_prefill(content_text, info)
+            more_text, more_info = self._request_with_retries(prompt, max_tokens, stop_after, system, prefill)
+            content_text, info = self._merge_continuation(prefill, info, more_text, more_info)
+        return content_text, info
+    
+    def _stage_max_tokens(self, stage, default):
+        """max_tokens to request for a stage: from the token budget when there is one"""
+        if not self.token_budget:
+            return default
+        return self.token_budget.max_tokens(stage, default)
+    
+    def _lookup_cache(self, prompt, max_tokens, stop_after, system=None, variant=None):
+        """Return (cache_key, cached_response) for a prompt, both None without a cache.
+        
+        variant separates otherwise identical requests, e.g. parallel code candidates.
+        """
+        if not self.cache:
+            return None, None
+        cache_key = self.cache.make_key(
+            model=self.model,
+            system=system,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            stop_after=stop_after,
+            prompt_version=PROMPT_VERSION,
+            **({"variant": variant} if variant else {})
+        )
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            print(f"Cache hit ({self.cache.hits} hits / {self.cache.misses} misses): "
+                  f"reusing response of length {len(cached)}")
+        return cache_key, cached
+    
+    def _log_prompt(self, prompt, max_tokens, system=None):
         print(f"Sending prompt to API with max_tokens={max_tokens}")
+        if system:
+            print(f"Cacheable system prefix: {len(system)} chars")
         print(f"Prompt first 100 chars: {prompt[:100]}...")
         print(f"Prompt last 100 chars: {prompt[-100:]}...")
+    
+    def _handle_response(self, content_text, info, cache_key, stage, wall_time):
+        """Log and record a fresh API response and store it in the cache"""
+        print(f"Received response of length: {len(content_text)}")
+        if info:
+            print(f"Input tokens: {info.get('input_tokens', 0)} uncached, "
+                  f"{info.get('cache_read_input_tokens', 0)} read from prompt cache, "
+                  f"{info.get('cache_creation_input_tokens', 0)} written to prompt cache; "
+                  f"output tokens: {info.get('output_tokens', 0)}")
+        ttft = info.get("time_to_first_token")
+        print(f"Stop reason: {info.get('stop_reason')}, wall time: {wall_time:.2f}s"
+              + (f", time to first token: {ttft:.2f}s" if ttft is not None else ""))
+        record_call(stage, cached=False, wall_time=wall_time, **info)
+        if info.get("continuations"):
+            print(f"Response completed after {info['continuations']} continuation(s)")
+        
+        # Learn the stage's response length; a response still cut off at max_tokens says too little
+        if self.token_budget and info.get("stop_reason") != "max_tokens":
+            output_tokens = info.get("output_tokens")
+            if info.get("stop_reason") == "early_stop":
+                # The stream was closed before the final usage arrived
+                output_tokens = estimate_tokens(content_text)
+            self.token_budget.record(stage, output_tokens)
+        print(f"Response first 100 chars: {content_text[:100]}...")
+        print(f"Response last 100 chars: {content_text[-100:]}...")
+        
+        # Check for <CODE_START> and <CODE_END> tags
+        if "<CODE_START>" in content_text and "<CODE_END>" in content_text:
+            print("SUCCESS: Found <CODE_START> and <CODE_END> tags in response")
+        else:
+            print("WARNING: <CODE_START> or <CODE_END> tags not found in response")
+            # Print snippets around potential code areas
+            if "```python" in content_text:
+                print("Found '```python' in response - checking context:")
+                index = content_text.find("```python")
+                context_start = max(0, index - 50)
+                context_end = min(len(content_text), index + 50)
+                print(f"Context around ```python: {content_text[context_start:context_end]}")
+            
+            if "```" in content_text:
+                print(f"Found {content_text.count('```')} occurrences of ``` in response")
+        
+        if cache_key:
+            self.cache.put(cache_key, content_text, model=self.model)
+        
+        return content_text
+    
+    def _check_cache(self, prompt, max_tokens, stop_after, system, stage, variant=None):
+        """Return (cache_key, cached_response, skip) before an API call.
+        
+        skip is True in cache-only mode when the response is not cached.
+        """
+        cache_key, cached = self._lookup_cache(prompt, max_tokens, stop_after, system, variant)
+        if cached is not None:
+            record_call(stage, cached=True, wall_time=0.0, stop_reason="response_cache")
+            return cache_key, cached, False
+        if self.cache and self.cache.cache_only:
+            print("Cache miss in cache-only mode - skipping API call")
+            return cache_key, None, True
+        return cache_key, None, False
+    
+    def _send_prompt(self, prompt, max_tokens=3000, stop_after=None, system=None, stage="other",
+                     variant=None):
+        """Helper method to send a prompt to the API and get the text response.
+        
+        max_tokens is the stage default; with a token budget the request uses the
+        budget's value instead. Truncated responses are continued, so the cached
+        response does not depend on the limit actually requested.
+        """
+        request_max_tokens = self._stage_max_tokens(stage, max_tokens)
+        self._log_prompt(prompt, request_max_tokens, system)
+        
+        cache_key, cached, skip = self._check_cache(prompt, max_tokens, stop_after, system, stage, variant)
+        if cached is not None or skip:
+            return cached
         
         try:
-            message = self.client.messages.create(
-                model=self.model,
-                max_tokens=max_tokens,
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }]
-            )
-            
-            # Get the text content from the response
-            content_text = ""
-            for content_block in message.content:
-                if content_block.type == "text":
-                    content_text += content_block.text
-            
-            print(f"Received response of length: {len(content_text)}")
-            print(f"Response first 100 chars: {content_text[:100]}...")
-            print(f"Response last 100 chars: {content_text[-100:]}...")
-            
-            # Check for <CODE_START> and <CODE_END> tags
-            if "<CODE_START>" in content_text and "<CODE_END>" in content_text:
-                print("SUCCESS: Found <CODE_START> and <CODE_END> tags in response")
-            else:
-                print("WARNING: <CODE_START> or <CODE_END> tags not found in response")
-                # Print snippets around potential code areas
-                if "```python" in content_text:
-                    print("Found '```python' in response - checking context:")
-                    index = content_text.find("```python")
-                    context_start = max(0, index - 50)
-                    context_end = min(len(content_text), index + 50)
-                    print(f"Context around ```python: {content_text[context_start:context_end]}")
-                
-                if "```" in content_text:
-                    print(f"Found {content_text.count('```')} occurrences of ``` in response")
-            
-            return content_text
+            started = time.monotonic()
+            content_text, info = self._request_complete(prompt, request_max_tokens, stop_after, system)
+            return self._handle_response(content_text, info, cache_key, stage, time.monotonic() - started)
         except Exception as e:
             print(f"Error sending prompt: {e}")
             return None
     
-    def analyze_concept(self, math_topic, audience_level="high school"):
-        """Break down a mathematical concept for visualization"""
+    # -------------------------------------------------------------------------
+    # Stage prompts and response parsing, shared by the sync and async clients
+    # -------------------------------------------------------------------------
+    
+    def _concept_prompt(self, math_topic, audience_level):
         print(f"\n[STEP 1] Analyzing concept: {math_topic} for {audience_level} audience")
-        formatted_prompt = CONCEPT_BREAKDOWN.format(
+        return CONCEPT_BREAKDOWN.format(
             topic=math_topic,
             audience_level=audience_level
         )
-        response = self._send_prompt(formatted_prompt, max_tokens=3500)
-        
+    
+    def _parse_concept(self, response):
         # Extract the key sections from the response
-        concept_analysis = extract_section(response, "concept_analysis")
-        visualization_approach = extract_section(response, "visualization_approach")
-        key_visual_elements = extract_section(response, "key_visual_elements")
+        sections = parse_sections(response)
+        concept_analysis = sections.get("concept_analysis")
+        visualization_approach = sections.get("visualization_approach")
+        key_visual_elements = sections.get("key_visual_elements")
         
         print(f"Extracted concept_analysis: {len(concept_analysis) if concept_analysis else 0} chars")
         print(f"Extracted visualization_approach: {len(visualization_approach) if visualization_approach else 0} chars")
@@ -81,8 +352,7 @@ class ManimGenerator:
             "full_response": response
         }
     
-    def design_scene(self, math_topic, audience_level="high school", concept_analysis=None):
-        """Generate an animation design for a given math topic"""
+    def _design_prompt(self, math_topic, audience_level, concept_analysis):
         print(f"\n[STEP 2] Designing scene for: {math_topic}")
         formatted_prompt = DESIGN.format(
             topic=math_topic,
@@ -94,11 +364,13 @@ class ManimGenerator:
             formatted_prompt += f"\n\n<concept_analysis>\n{concept_analysis}\n</concept_analysis>"
             print("Included concept_analysis in design prompt")
         
-        response = self._send_prompt(formatted_prompt, max_tokens=3500)
-        
+        return formatted_prompt
+    
+    def _parse_design(self, response):
         # Extract the animation design section
-        animation_design = extract_section(response, "animation_design")
-        self_evaluation = extract_section(response, "self_evaluation")
+        sections = parse_sections(response)
+        animation_design = sections.get("animation_design")
+        self_evaluation = sections.get("self_evaluation")
         
         print(f"Extracted animation_design: {len(animation_design) if animation_design else 0} chars")
         print(f"Extracted self_evaluation: {len(self_evaluation) if self_evaluation else 0} chars")
@@ -109,21 +381,20 @@ class ManimGenerator:
             "full_response": response
         }
     
-    def test_animation_design(self, math_topic, animation_design):
-        """Test an animation design for potential issues"""
+    def _testing_prompt(self, math_topic, animation_design):
         print(f"\n[STEP 3] Testing animation design for: {math_topic}")
-        formatted_prompt = ANIMATION_TESTING.format(
+        return ANIMATION_TESTING.format(
             topic=math_topic,
             animation_design=animation_design
         )
-        
-        response = self._send_prompt(formatted_prompt, max_tokens=3000)
-        
+    
+    def _parse_testing(self, response):
         # Extract the key sections
-        novice_viewer = extract_section(response, "novice_viewer")
-        expert_viewer = extract_section(response, "expert_viewer")
-        cognitive_load = extract_section(response, "cognitive_load_analysis")
-        improvements = extract_section(response, "design_improvements")
+        sections = parse_sections(response)
+        novice_viewer = sections.get("novice_viewer")
+        expert_viewer = sections.get("expert_viewer")
+        cognitive_load = sections.get("cognitive_load_analysis")
+        improvements = sections.get("design_improvements")
         
         print(f"Extracted novice_viewer: {len(novice_viewer) if novice_viewer else 0} chars")
         print(f"Extracted expert_viewer: {len(expert_viewer) if expert_viewer else 0} chars")
@@ -138,28 +409,47 @@ class ManimGenerator:
             "full_response": response
         }
     
-    def generate_code(self, design, topic):
-        """Generate Manim code based on the design"""
-        print(f"\n[STEP 4] Generating code for: {topic}")
+    def _fused_prompt(self, math_topic, audience_level):
+        print(f"\n[STEPS 1-3] Analyzing, designing and reviewing in one call: {math_topic}")
+        return FUSED_ANALYSIS.format(
+            topic=math_topic,
+            audience_level=audience_level
+        )
+    
+    def _parse_fused(self, response):
+        # The fused response carries every section, so each stage parser reads the same text
+        concept_results = self._parse_concept(response)
+        design_results = self._parse_design(response)
+        test_results = self._parse_testing(response)
+        if not design_results["animation_design"]:
+            print("WARNING: Fused response is missing the animation_design section")
+        return concept_results, design_results, test_results
+    
+    def _safe_class_name(self, topic):
         # Create a safe class name for the topic
         safe_class_name = ''.join(word.title() for word in topic.split()) + 'Scene'
         print(f"Using safe class name: {safe_class_name}")
+        return safe_class_name
+    
+    def _code_prompt(self, design, topic):
+        print(f"\n[STEP 4] Generating code for: {topic}")
+        safe_class_name = self._safe_class_name(topic)
         
         # Format the prompt with topic and design
         formatted_prompt = CODE_GENERATION.format(
             topic=topic,
             design_scene=design,
-            safe_class_name=safe_class_name,
-            TOPIC=topic,  # Added for template compatibility
-            SAFE_CLASS_NAME=safe_class_name  # Added for template compatibility
+            safe_class_name=safe_class_name
         )
         
         # Add debug info directly to prompt
         formatted_prompt += "\n\nIMPORTANT DEBUG NOTE: The system REQUIRES you to include EXACT <CODE_START> and <CODE_END> tags around your code. DO NOT use markdown triple backticks or any variations. The format must be exactly as shown in the example with unmodified tags."
         
         print("Sending code generation prompt with debug note added")
-        response = self._send_prompt(formatted_prompt, max_tokens=5000)
-        
+        return formatted_prompt
+    
+    def _parse_code(self, response, topic):
+        """Return (clean_code, self_evaluation) from a code generation response"""
         # Debug the raw response
         print("\nDEBUG: Checking raw response for code tags:")
         if "<CODE_START>" in response:
@@ -188,56 +478,136 @@ class ManimGenerator:
         clean_code = extract_code_only(response, topic)
         print(f"Extracted code length: {len(clean_code) if clean_code else 0} chars")
         
-        self_evaluation = extract_section(response, "code_self_evaluation")
+        self_evaluation = parse_sections(response).get("code_self_evaluation")
         print(f"Extracted self_evaluation: {len(self_evaluation) if self_evaluation else 0} chars")
+        return clean_code, self_evaluation
+    
+    def _code_repair_prompt(self, response, topic):
+        print(f"\nERROR: Failed to extract valid code for topic '{topic}'")
+        safe_class_name = self._safe_class_name(topic)
+        
+        if "<CODE_START>" in response and "<CODE_END>" in response:
+            problem = (f"The code does not show that it is about {topic}. Name the scene class "
+                       f"{safe_class_name} and mention {topic} in the code comments.")
+        else:
+            problem = ("The code is not wrapped in <CODE_START> and <CODE_END> tags. "
+                       "Markdown code fences are not accepted.")
+        print(f"Requesting a targeted repair: {problem}")
+        
+        # The planning section is not needed to fix the code, so leave it out
+        planning_end = response.find("</animation_planning>")
+        if planning_end != -1:
+            response = response[planning_end + len("</animation_planning>"):].strip()
+        
+        return CODE_REPAIR.format(
+            topic=topic,
+            safe_class_name=safe_class_name,
+            problem=problem,
+            failed_response=response
+        )
+    
+    def _parse_code_retry(self, retry_response, topic):
+        if not retry_response:
+            print("ERROR: No response received for repair prompt")
+            return None
         
-        # Handle case where code extraction or topic validation failed
+        print("\nDEBUG: Checking repair response for code tags:")
+        if "<CODE_START>" in retry_response:
+            start_idx = retry_response.find("<CODE_START>")
+            print(f"Found <CODE_START> tag at position {start_idx}")
+        else:
+            print("ERROR: <CODE_START> tag still not found in repair response")
+        
+        if "<CODE_END>" in retry_response:
+            end_idx = retry_response.find("<CODE_END>")
+            print(f"Found <CODE_END> tag at position {end_idx}")
+        else:
+            print("ERROR: <CODE_END> tag still not found in repair response")
+        
+        clean_code = extract_code_only(retry_response, topic)
+        print(f"Extracted code from repair: {len(clean_code) if clean_code else 0} chars")
+        return clean_code
+    
+    def _render_fix_prompt(self, code, error, topic):
+        print(f"\n[RENDER FIX] Requesting a patch for the render error in: {topic}")
+        return RENDER_FIX.format(
+            code=code,
+            error=error[-RENDER_ERROR_CHARS:]
+        )
+    
+    def _parse_render_fix(self, response, code):
+        patched_code = apply_patches(code, response)
+        print(f"Patched code: {len(patched_code) if patched_code else 0} chars")
+        return {
+            "code": patched_code,
+            "full_response": response
+        }
+    
+    def _code_failure(self, response, error):
+        print(f"ERROR: {error}")
+        return {
+            "code": None,
+            "self_evaluation": None,
+            "full_response": response,
+            "error": error
+        }
+    
+    # -------------------------------------------------------------------------
+    # Pipeline stages
+    # -------------------------------------------------------------------------
+    
+    def analyze_concept(self, math_topic, audience_level="high school"):
+        """Break down a mathematical concept for visualization"""
+        formatted_prompt = self._concept_prompt(math_topic, audience_level)
+        response = self._send_prompt(formatted_prompt, max_tokens=3500, system=CONCEPT_BREAKDOWN_SYSTEM,
+                                     stage="concept_analysis")
+        return self._parse_concept(response)
+    
+    def design_scene(self, math_topic, audience_level="high school", concept_analysis=None):
+        """Generate an animation design for a given math topic"""
+        formatted_prompt = self._design_prompt(math_topic, audience_level, concept_analysis)
+        response = self._send_prompt(formatted_prompt, max_tokens=3500, system=DESIGN_SYSTEM,
+                                     stage="animation_design")
+        return self._parse_design(response)
+    
+    def test_animation_design(self, math_topic, animation_design):
+        """Test an animation design for potential issues"""
+        formatted_prompt = self._testing_prompt(math_topic, animation_design)
+        response = self._send_prompt(formatted_prompt, max_tokens=3000, system=ANIMATION_TESTING_SYSTEM,
+                                     stage="design_testing")
+        return self._parse_testing(response)
+    
+    def analyze_and_design(self, math_topic, audience_level="high school"):
+        """Fused mode: concept analysis, design and design testing in a single API call.
+        
+        Returns (concept_results, design_results, test_results) with the same keys
+        as analyze_concept, design_scene and test_animation_design.
+        """
+        formatted_prompt = self._fused_prompt(math_topic, audience_level)
+        response = self._send_prompt(formatted_prompt, max_tokens=8000, system=FUSED_ANALYSIS_SYSTEM,
+                                     stage="fused_analysis")
+        return self._parse_fused(response)
+    
+    def generate_code(self, design, topic):
+        """Generate Manim code based on the design"""
+        formatted_prompt = self._code_prompt(design, topic)
+        # Only the code block is used downstream, so stop once <CODE_END> arrives
+        response = self._send_prompt(formatted_prompt, max_tokens=5000, stop_after=CODE_STOP,
+                                     system=CODE_GENERATION_SYSTEM, stage="code_generation")
+        if not response:
+            return self._code_failure(response, f"No response received for '{topic}'")
+        
+        clean_code, self_evaluation = self._parse_code(response, topic)
+        
+        # Handle case where code extraction or topic validation failed: ask for a repair
+        # of this response rather than regenerating from the design
         if not clean_code:
-            print(f"\nERROR: Failed to extract valid code for topic '{topic}'")
-            print("The generated code may not be relevant to the requested topic.")
-            print("Attempting to prompt Claude again with stronger topic emphasis...")
-            
-            # Try again with even stronger topic emphasis
-            retry_prompt = CODE_GENERATION.format(
-                topic=topic,
-                design_scene=design,
-                safe_class_name=safe_class_name,
-                TOPIC=topic,
-                SAFE_CLASS_NAME=safe_class_name
-            )
-            retry_prompt += f"\n\nCRITICAL: You MUST create a MANIM animation about {topic}. " \
-                        f"The class name should include '{topic.replace(' ', '')}' and " \
-                        f"the code must explicitly be about {topic} in its comments and visuals."
-            
-            retry_prompt += "\n\nABSOLUTELY CRITICAL: You MUST wrap your code in <CODE_START> and <CODE_END> tags EXACTLY as shown below. DO NOT use markdown formatting, DO NOT use triple backticks, ONLY use these exact tags:\n\n<CODE_START>\n# Your code here\n<CODE_END>"
-            
-            print("Sending retry prompt with CRITICAL tag instructions")
-            retry_response = self._send_prompt(retry_prompt, max_tokens=5000)
-            
-            print("\nDEBUG: Checking retry response for code tags:")
-            if "<CODE_START>" in retry_response:
-                start_idx = retry_response.find("<CODE_START>")
-                print(f"Found <CODE_START> tag at position {start_idx}")
-            else:
-                print("ERROR: <CODE_START> tag still not found in retry response")
-                
-            if "<CODE_END>" in retry_response:
-                end_idx = retry_response.find("<CODE_END>")
-                print(f"Found <CODE_END> tag at position {end_idx}")
-            else:
-                print("ERROR: <CODE_END> tag still not found in retry response")
-            
-            clean_code = extract_code_only(retry_response, topic)
-            print(f"Extracted code from retry: {len(clean_code) if clean_code else 0} chars")
-            
+            repair_prompt = self._code_repair_prompt(response, topic)
+            retry_response = self._send_prompt(repair_prompt, max_tokens=5000, stop_after=CODE_STOP,
+                                               system=CODE_REPAIR_SYSTEM, stage="code_repair")
+            clean_code = self._parse_code_retry(retry_response, topic)
             if not clean_code:
-                print("ERROR: Still failed to generate relevant code after retry.")
-                return {
-                    "code": None,
-                    "self_evaluation": None,
-                    "full_response": response,
-                    "error": f"Failed to generate code relevant to '{topic}'"
-                }
+                return self._code_failure(response, f"Failed to generate code relevant to '{topic}'")
         
         return {
             "code": clean_code,
@@ -245,6 +615,17 @@ class ManimGenerator:
             "full_response": response
         }
     
+    def fix_render_error(self, code, error, topic):
+        """Ask for a minimal search/replace patch that fixes a Manim render error.
+        
+        Returns a dict whose "code" is the patched code, or None if the patches
+        could not be applied.
+        """
+        formatted_prompt = self._render_fix_prompt(code, error, topic)
+        response = self._send_prompt(formatted_prompt, max_tokens=2000, stop_after=PATCH_STOP,
+                                     system=RENDER_FIX_SYSTEM, stage="render_fix")
+        return self._parse_render_fix(response, code)
+    
     def process_feedback(self, math_topic, original_code, user_feedback, feedback_tags=None):
         """Process user feedback and improve the animation"""
         print(f"\n[FEEDBACK] Processing feedback for: {math_topic}")
@@ -261,10 +642,11 @@ class ManimGenerator:
         response = self._send_prompt(formatted_prompt, max_tokens=4000)
         
         # Extract the key sections
-        feedback_analysis = extract_section(response, "feedback_analysis")
-        improvements = extract_section(response, "proposed_improvements")
+        sections = parse_sections(response)
+        feedback_analysis = sections.get("feedback_analysis")
+        improvements = sections.get("proposed_improvements")
         improved_code = extract_code_only(response)
-        improvement_summary = extract_section(response, "improvement_summary")
+        improvement_summary = sections.get("improvement_summary")
         
         print(f"Extracted feedback_analysis: {len(feedback_analysis) if feedback_analysis else 0} chars")
         print(f"Extracted improvements: {len(improvements) if improvements else 0} chars")
@@ -335,4 +717,153 @@ class ManimGenerator:
             "code_generation": code_results,
             "final_code": final_code,
             "summary": summary
-        }
\ No newline at end of file
+        }
+
+
+class AsyncManimGenerator(ManimGenerator):
+    """asyncio-native variant of ManimGenerator.
+    
+    Prompt construction, caching and response parsing are inherited; only the
+    transport is async, so many topics can be in flight in a single process.
+    Call close() when done so the underlying HTTP client is released.
+    """
+    
+    def _create_client(self, api_key, max_retries):
+        return anthropic.AsyncAnthropic(api_key=api_key, max_retries=max_retries)
+    
+    async def close(self):
+        await self.client.close()
+    
+    async def _request(self, prompt, max_tokens, stop_after=None, system=None, prefill=None):
+        """Async counterpart of ManimGenerator._request"""
+        request = self._build_request(prompt, max_tokens, stop_after, system, prefill)
+        
+        if not self.streaming:
+            message = await self.client.messages.create(**request)
+            return self._message_text(message)
+        
+        response = _StreamedResponse(stop_after)
+        stream = await self.client.messages.create(stream=True, **request)
+        try:
+            async for event in stream:
+                if response.handle(event):
+                    break
+        finally:
+            await stream.close()
+        return response.result()
+    
+    async def _request_with_retries(self, prompt, max_tokens, stop_after=None, system=None, prefill=None):
+        """Async counterpart of ManimGenerator._request_with_retries"""
+        if not self.rate_limiter:
+            return await self._request(prompt, max_tokens, stop_after, system, prefill)
+        
+        estimated = estimate_tokens(system, prompt, prefill)
+        for attempt in range(self.rate_limiter.max_retries + 1):
+            await self.rate_limiter.acquire_async(estimated)
+            try:
+                content_text, info = await self._request(prompt, max_tokens, stop_after, system, prefill)
+            except anthropic.APIStatusError as e:
+                if not is_retryable(e) or attempt == self.rate_limiter.max_retries:
+                    raise
+                await asyncio.sleep(self.rate_limiter.backoff(attempt, e))
+                continue
+            self.rate_limiter.record_usage(estimated, info.get("input_tokens", 0)
+                                           + info.get("cache_creation_input_tokens", 0))
+            return content_text, info
+    
+    async def _request_complete(self, prompt, max_tokens, stop_after=None, system=None):
+        """Async counterpart of ManimGenerator._request_complete"""
+        content_text, info = await self._request_with_retries(prompt, max_tokens, stop_after, system)
+        for _ in range(MAX_CONTINUATIONS):
+            if info.get("stop_reason") != "max_tokens":
+                break
+            prefill = self._continuation_prefill(content_text, info)
+            more_text, more_info = await self._request_with_retries(prompt, max_tokens, stop_after, system,
+                                                                    prefill)
+            content_text, info = self._merge_continuation(prefill, info, more_text, more_info)
+        return content_text, info
+    
+    async def _send_prompt(self, prompt, max_tokens=3000, stop_after=None, system=None, stage="other",
+                           variant=None):
+        """Async counterpart of ManimGenerator._send_prompt"""
+        request_max_tokens = self._stage_max_tokens(stage, max_tokens)
+        self._log_prompt(prompt, request_max_tokens, system)
+        
+        cache_key, cached, skip = self._check_cache(prompt, max_tokens, stop_after, system, stage, variant)
+        if cached is not None or skip:
+            return cached
+        
+        try:
+            started = time.monotonic()
+            content_text, info = await self._request_complete(prompt, request_max_tokens, stop_after, system)
+            return self._handle_response(content_text, info, cache_key, stage, time.monotonic() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending prompt: {e}")
+            return None
+    
+    async def analyze_concept(self, math_topic, audience_level="high school"):
+        """Break down a mathematical concept for visualization"""
+        formatted_prompt = self._concept_prompt(math_topic, audience_level)
+        response = await self._send_prompt(formatted_prompt, max_tokens=3500, system=CONCEPT_BREAKDOWN_SYSTEM,
+                                           stage="concept_analysis")
+        return self._parse_concept(response)
+    
+    async def design_scene(self, math_topic, audience_level="high school", concept_analysis=None):
+        """Generate an animation design for a given math topic"""
+        formatted_prompt = self._design_prompt(math_topic, audience_level, concept_analysis)
+        response = await self._send_prompt(formatted_prompt, max_tokens=3500, system=DESIGN_SYSTEM,
+                                           stage="animation_design")
+        return self._parse_design(response)
+    
+    async def test_animation_design(self, math_topic, animation_design):
+        """Test an animation design for potential issues"""
+        formatted_prompt = self._testing_prompt(math_topic, animation_design)
+        response = await self._send_prompt(formatted_prompt, max_tokens=3000, system=ANIMATION_TESTING_SYSTEM,
+                                           stage="design_testing")
+        return self._parse_testing(response)
+    
+    async def analyze_and_design(self, math_topic, audience_level="high school"):
+        """Fused mode: concept analysis, design and design testing in a single API call"""
+        formatted_prompt = self._fused_prompt(math_topic, audience_level)
+        response = await self._send_prompt(formatted_prompt, max_tokens=8000, system=FUSED_ANALYSIS_SYSTEM,
+                                           stage="fused_analysis")
+        return self._parse_fused(response)
+    
+    async def generate_code(self, design, topic, variant=None):
+        """Generate Manim code based on the design.
+        
+        variant gives speculative candidates their own cache entries so each one
+        is an independent sample rather than a copy of the first.
+        """
+        formatted_prompt = self._code_prompt(design, topic)
+        response = await self._send_prompt(formatted_prompt, max_tokens=5000, stop_after=CODE_STOP,
+                                           system=CODE_GENERATION_SYSTEM, stage="code_generation",
+                                           variant=variant)
+        if not response:
+            return self._code_failure(response, f"No response received for '{topic}'")
+        
+        clean_code, self_evaluation = self._parse_code(response, topic)
+        
+        if not clean_code:
+            repair_prompt = self._code_repair_prompt(response, topic)
+            retry_response = await self._send_prompt(repair_prompt, max_tokens=5000, stop_after=CODE_STOP,
+                                                     system=CODE_REPAIR_SYSTEM, stage="code_repair",
+                                                     variant=variant)
+            clean_code = self._parse_code_retry(retry_response, topic)
+            if not clean_code:
+                return self._code_failure(response, f"Failed to generate code relevant to '{topic}'")
+        
+        return {
+            "code": clean_code,
+            "self_evaluation": self_evaluation,
+            "full_response": response
+        }
+    
+    async def fix_render_error(self, code, error, topic):
+        """Ask for a minimal search/replace patch that fixes a Manim render error"""
+        formatted_prompt = self._render_fix_prompt(code, error, topic)
+        response = await self._send_prompt(formatted_prompt, max_tokens=2000, stop_after=PATCH_STOP,
+                                           system=RENDER_FIX_SYSTEM, stage="render_fix")
+        return self._parse_render_fix(response, code)
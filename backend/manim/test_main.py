@@ -0,0 +1,47 @@
+import argparse
+import concurrent.futures
+import types
+
+import main
+from generate_video import VideoResult
+
+
+class FakeResponse:
+    status_code = 201
+    text = ""
+
+    def json(self):
+        return {"data": {"_id": "1"}}
+
+
+def run_save_result(monkeypatch, tmp_path, result):
+    """Call save_result with the server replaced; returns the JSON posted to save-from-python"""
+    posted = []
+    monkeypatch.setattr(main.requests, "get", lambda url: types.SimpleNamespace(status_code=200, text=""))
+    monkeypatch.setattr(main.requests, "post", lambda url, json, **kwargs: posted.append((url, json)) or FakeResponse())
+    args = argparse.Namespace(server_url="http://server", audience="high school")
+    video_gen = types.SimpleNamespace(code_dir=str(tmp_path), videos_dir=str(tmp_path))
+    main.save_result(args, video_gen, "vectors", result, None)
+    assert [url for url, _ in posted] == ["http://server/videos/save-from-python"]
+    return posted[0][1]
+
+
+def test_save_result_posts_preview_with_pending_upgrade(monkeypatch, tmp_path):
+    video_path = tmp_path / "vectors_animation.mp4"
+    video_path.write_text("mp4")
+    code_path = tmp_path / "generated_vectors.py"
+    code_path.write_text("class VectorsScene(Scene): pass")
+    result = VideoResult(True, str(video_path), str(code_path), {}, concurrent.futures.Future())
+
+    data = run_save_result(monkeypatch, tmp_path, result)
+    assert data["status"] == "completed"
+    assert data["videoPath"] == str(video_path)
+    assert data["code"] == "class VectorsScene(Scene): pass"
+    assert data["quality"] == "preview"
+
+
+def test_save_result_posts_failure(monkeypatch, tmp_path):
+    data = run_save_result(monkeypatch, tmp_path, VideoResult(False, None, None, None, None))
+    assert data["status"] == "failed"
+    assert data["videoPath"] == ""
+    assert data["quality"] == "final"
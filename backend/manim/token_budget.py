@@ -0,0 +1,68 @@
+import json
+import math
+import os
+import threading
+
+
+class TokenBudget:
+    """Per-stage max_tokens chosen from the output lengths of past calls.
+
+    Output token counts are kept per stage in a small JSON history file. Once a
+    stage has enough samples, its max_tokens is the configured percentile of
+    those counts plus some headroom; until then the caller's default is used.
+    Responses that still hit the limit are continued by the generator, so a
+    tight budget costs an extra request rather than a truncated file.
+    """
+
+    def __init__(self, history_file, percentile=95, headroom=1.25, min_samples=5,
+                 max_samples=200, floor=512, ceiling=8192):
+        self.history_file = history_file
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.floor = floor
+        self.ceiling = ceiling
+        self._lock = threading.Lock()
+        self._history = self._load()
+
+    def _load(self):
+        try:
+            with open(self.history_file, 'r') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return history if isinstance(history, dict) else {}
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.history_file)), exist_ok=True)
+        tmp_path = f"{self.history_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self._history, f)
+        os.replace(tmp_path, self.history_file)
+
+    def max_tokens(self, stage, default):
+        """Return the max_tokens to request for stage, or default without enough history"""
+        with self._lock:
+            samples = sorted(self._history.get(stage, []))
+        if len(samples) < self.min_samples:
+            return default
+
+        index = max(0, math.ceil(self.percentile / 100 * len(samples)) - 1)
+        budget = samples[index] * self.headroom
+        # Round up to a multiple of 256 so small history changes do not alter every request
+        budget = int(math.ceil(budget / 256) * 256)
+        return max(self.floor, min(self.ceiling, budget))
+
+    def record(self, stage, output_tokens):
+        """Add the output length of a complete response to the stage's history"""
+        if not output_tokens:
+            return
+        with self._lock:
+            samples = self._history.setdefault(stage, [])
+            samples.append(int(output_tokens))
+            del samples[:-self.max_samples]
+            try:
+                self._save()
+            except OSError as e:
+                print(f"Could not save token history: {e}")
@@ -13,7 +13,12 @@ const videoSchema = new mongoose.Schema({
         type: String,
         enum: ['pending', 'processing', 'completed', 'failed'],
         default: 'pending'
-    } 
+    },
+    quality: {
+        type: String,
+        enum: ['preview', 'final'],
+        default: 'final'
+    }
 }, {
     timestamps: true
 });
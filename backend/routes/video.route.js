@@ -84,39 +84,23 @@ router.post('/upload', upload.single('video'), async (req, res) => {
     }
 });
 
-// Route for Python script to save video metadata and have server copy the video
+// Route for Python script to save video metadata for a video it has already written
 router.post('/save-from-python', async (req, res) => {
     try {
-        const { topic, code, status, videoPath } = req.body;
+        const { topic, code, status, videoPath, quality } = req.body;
         
         if (!topic) {
             return res.status(400).json({ success: false, message: "Topic is required" });
         }
         
-        // Create a safe filename based on the topic
-        const safeTopic = topic.replace(/[^a-zA-Z0-9_]/g, '_').toLowerCase();
-        
         // If videoPath is provided, check if it exists
         let finalVideoPath = "";
         if (videoPath) {
             // Check if the file exists at the specified path
             if (fs.existsSync(videoPath)) {
-                // Copy the file to the videos directory
-                const fileName = `${safeTopic}_animation.mp4`;
-                const destDir = path.join(process.cwd(), 'backend', 'manim', 'content', 'video_dir');
-                
-                // Create directory if it doesn't exist
-                if (!fs.existsSync(destDir)) {
-                    fs.mkdirSync(destDir, { recursive: true });
-                }
-                
-                const destPath = path.join(destDir, fileName);
-                
-                // Copy the file
-                fs.copyFileSync(videoPath, destPath);
-                
+                // Python renames the video into the served directory itself, so no copy is needed.
                 // Set the path for database storage (URL format)
-                finalVideoPath = `/videos/${fileName}`;
+                finalVideoPath = `/videos/${path.basename(videoPath)}`;
             } else {
                 console.log(`Warning: Video file not found at path: ${videoPath}`);
             }
@@ -129,6 +113,7 @@ router.post('/save-from-python', async (req, res) => {
             videoPath: finalVideoPath,
             code: code || "",
             status: status || "completed",
+            quality: quality || "final",
             description: `Animation for ${topic}`
         };
         
@@ -146,6 +131,32 @@ router.post('/save-from-python', async (req, res) => {
     }
 });
 
+// Route for Python script to replace a preview video with its final-quality render
+router.post('/upgrade-from-python', async (req, res) => {
+    try {
+        const { topic, videoPath, quality } = req.body;
+        
+        if (!topic || !videoPath) {
+            return res.status(400).json({ success: false, message: "Topic and videoPath are required" });
+        }
+        if (!fs.existsSync(videoPath)) {
+            return res.status(400).json({ success: false, message: `Video file not found at path: ${videoPath}` });
+        }
+        
+        // Python has already renamed the final render over the preview, so clients never read a partial video
+        const video = await Video.findOneAndUpdate(
+            { name: `${topic} Animation` },
+            { videoPath: `/videos/${path.basename(videoPath)}`, quality: quality || "final" },
+            { sort: { createdAt: -1 }, new: true }
+        );
+        
+        res.status(200).json({ success: true, message: "Video upgraded successfully", data: video });
+    } catch (error) {
+        console.log("Error upgrading video: ", error);
+        res.status(500).json({ success: false, message: "Server error" });
+    }
+});
+
 // Get a single video by ID
 router.get('/:id', async (req, res) => {
     try {